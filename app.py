@@ -1,26 +1,98 @@
+import click
 from flask import Flask
 from flask_login import LoginManager
 
 from config import settings
-from db.database import init_db, session_scope
+from db.database import init_db, migrations_available, session_scope, engine
 from routes import main_blueprint
 from db.models import User
+from db.catalog_import import import_books, read_books
+from db.ratings import rebuild_ratings
+from db.order_lines import backfill_order_lines
+from db.sales import rebuild_sales
+from db.catalog_version import bump_catalog_version, bump_sales_version
+from db.user_cache import user_cache
+from metrics import init_metrics
+from static_images import Image, build_static_images, init_static_images
+from covers import find_covers, ingest_covers, init_covers
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = settings.SECRET_KEY
 app.register_blueprint(main_blueprint)
+init_metrics(app, engine)
+init_static_images(app)
+init_covers(app)
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'main.login'
 
 @login_manager.user_loader
 def load_user(user_id):
+    user = user_cache.get(int(user_id))
+    if user is not None:
+        return user
     with session_scope() as session:
         user = session.query(User).filter_by(id=user_id).first()
         if user:
             session.expunge(user)
+            user_cache.put(user.id, user)
         return user
 
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, show_default=True, help='Количество книг в одной транзакции.')
+def import_books_command(path, batch_size):
+    init_db()
+    stats = import_books(read_books(path), batch_size=batch_size)
+    click.echo(f"Загружено {stats['rows']} книг за {stats['seconds']:.1f} с ({stats['rows_per_sec']:.0f} строк/с)")
+
+@app.cli.command('db-migrate')
+def db_migrate_command():
+    if not migrations_available():
+        raise click.ClickException('Через PgBouncer миграции не применяются: задайте прямое подключение DB_DIRECT_URL')
+    applied = init_db()
+    click.echo(f"Применены миграции: {', '.join(map(str, applied))}" if applied else 'Схема БД актуальна')
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    with session_scope() as session:
+        books_count = rebuild_ratings(session)
+        bump_catalog_version(session)
+    click.echo(f'Пересчитаны оценки {books_count} книг')
+
+@app.cli.command('backfill-order-lines')
+@click.option('--batch-size', default=1000, show_default=True, help='Количество заказов в одной транзакции.')
+def backfill_order_lines_command(batch_size):
+    init_db()
+    stats = backfill_order_lines(batch_size=batch_size)
+    click.echo(f"Просмотрено {stats['orders']} заказов за {stats['seconds']:.1f} с, добавлено строк: {stats['lines']}")
+
+@app.cli.command('rebuild-sales')
+def rebuild_sales_command():
+    init_db()
+    with session_scope() as session:
+        rebuild_sales(session)
+    bump_sales_version()
+    click.echo('Продажи по дням пересчитаны')
+
+@app.cli.command('build-images')
+def build_images_command():
+    if Image is None:
+        raise click.ClickException('Для сборки картинок нужен Pillow')
+    manifest = build_static_images(app.static_folder)
+    click.echo(f'Собраны варианты {len(manifest)} картинок в static/build')
+
+@app.cli.command('ingest-covers')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', default=0, help='Число процессов (0 - COVER_INGEST_WORKERS или по числу ядер).')
+def ingest_covers_command(directory, workers):
+    if Image is None:
+        raise click.ClickException('Для подготовки обложек нужен Pillow')
+    init_db()
+    stats = ingest_covers(find_covers(directory), workers=workers)
+    click.echo(f"Обработано {stats['files']} файлов за {stats['seconds']:.1f} с: обновлено книг {stats['books']}, "
+               f"ошибок {stats['failed']}")
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
\ No newline at end of file
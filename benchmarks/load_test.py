@@ -0,0 +1,205 @@
+"""Нагрузочный тест пользовательских сценариев магазина.
+
+Запускается против работающего приложения с локальной БД, в которую загружен каталог
+(flask --app app import-books ...):
+
+    python benchmarks/load_test.py --base-url http://127.0.0.1:5000 --users 20 --iterations 10 \
+        --output results.json --baseline previous.json --max-regression 0.2
+
+Каждый виртуальный пользователь регистрируется, входит и повторяет сценарий: главная, раздел
+каталога, поиск, страница книги, добавление в корзину, оформление и подтверждение заказа,
+история заказов. Для каждого шага печатаются p50/p95/p99 и пропускная способность, результат
+сохраняется в JSON. С --baseline скрипт завершается с кодом 1, если p95 какого-либо шага вырос
+больше чем на --max-regression.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SECTIONS = ['Художественная литература', 'Нехудожественная литература', 'Детская литература',
+            'Бизнес литература', 'Учебная литература', 'Весь ассортимент']
+SEARCH_WORDS = ['мир', 'тень', 'время', 'тайна', 'путь', 'Толстой', 'Азимов']
+STEPS = ['home', 'catalog', 'search', 'book', 'add_to_cart', 'cart', 'cart_submit', 'checkout_form',
+         'checkout', 'confirm_form', 'confirm_order', 'order_history']
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+BOOK_RE = re.compile(r'/book/(\d+)')
+CART_ITEM_RE = re.compile(r'name="for_order" value="(\d+)"')
+SQL_RE = re.compile(r'^bookshop_sql_statements_total\{endpoint="([^"]+)"\} (\S+)$', re.M)
+COUNT_RE = re.compile(r'^bookshop_request_duration_seconds_count\{endpoint="([^"]+)"\} (\S+)$', re.M)
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, step, session, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, allow_redirects=False, timeout=30, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.timings[step].append(elapsed)
+            if not ok:
+                self.errors[step] += 1
+        return response
+
+
+def csrf_token(response):
+    match = CSRF_RE.search(response.text) if response is not None else None
+    return match.group(1) if match else ''
+
+
+def simulate_user(base_url, iterations, recorder, rng):
+    session = requests.Session()
+    unique = uuid.uuid4()
+    name = f'bench_{unique.hex[:12]}'
+    password = 'benchmark-password'
+    page = session.get(f'{base_url}/register')
+    session.post(f'{base_url}/register', allow_redirects=False, data={
+        'csrf_token': csrf_token(page), 'username': name, 'email': f'{name}@example.com',
+        'phone_number': str(10 ** 9 + unique.int % (9 * 10 ** 9)), 'password': password, 'confirm_password': password,
+    })
+    page = session.get(f'{base_url}/login')
+    session.post(f'{base_url}/login', allow_redirects=False, data={
+        'csrf_token': csrf_token(page), 'email': f'{name}@example.com', 'password': password,
+    })
+    if session.get(f'{base_url}/user_orders', allow_redirects=False).status_code != 200:
+        raise RuntimeError(f'{name}: не удалось зарегистрироваться и войти')
+
+    for _ in range(iterations):
+        recorder.call('home', session, 'GET', f'{base_url}/')
+        response = recorder.call('catalog', session, 'GET', f'{base_url}/catalog/{rng.choice(SECTIONS)}')
+        book_ids = BOOK_RE.findall(response.text) if response is not None else []
+        recorder.call('search', session, 'GET', f'{base_url}/find_book', params={'text': rng.choice(SEARCH_WORDS)})
+        if not book_ids:
+            continue
+        book_id = rng.choice(book_ids)
+        recorder.call('book', session, 'GET', f'{base_url}/book/{book_id}')
+        recorder.call('add_to_cart', session, 'GET', f'{base_url}/add_to_cart/{book_id}')
+
+        response = recorder.call('cart', session, 'GET', f'{base_url}/cart')
+        cart_items = CART_ITEM_RE.findall(response.text) if response is not None else []
+        recorder.call('cart_submit', session, 'POST', f'{base_url}/cart', data={'for_order': cart_items})
+        response = recorder.call('checkout_form', session, 'GET', f'{base_url}/create_order')
+        recorder.call('checkout', session, 'POST', f'{base_url}/create_order', data={
+            'csrf_token': csrf_token(response), 'recipient': 'Бенчмарк', 'phone_number': '9000000000',
+            'delivery': 'Курьер', 'address': 'Тестовый адрес', 'payment': 'Карта',
+        })
+        response = recorder.call('confirm_form', session, 'GET', f'{base_url}/confirm_order')
+        recorder.call('confirm_order', session, 'POST', f'{base_url}/confirm_order', data={
+            'csrf_token': csrf_token(response), 'confirm': 'Подтвержден',
+        })
+        recorder.call('order_history', session, 'GET', f'{base_url}/user_orders')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def scrape_sql_counts(base_url):
+    """Число SQL-запросов и запросов к приложению по маршрутам из /metrics (если доступно)."""
+    try:
+        text = requests.get(f'{base_url}/metrics', timeout=10).text
+    except requests.RequestException:
+        return {}
+    statements = {endpoint: float(value) for endpoint, value in SQL_RE.findall(text)}
+    requests_count = {endpoint: float(value) for endpoint, value in COUNT_RE.findall(text)}
+    return {endpoint: (statements[endpoint], requests_count.get(endpoint, 0)) for endpoint in statements}
+
+
+def summarize(recorder, wall_seconds, sql_before, sql_after):
+    steps = {}
+    for step in STEPS:
+        timings = recorder.timings.get(step)
+        if not timings:
+            continue
+        steps[step] = {
+            'requests': len(timings),
+            'errors': recorder.errors.get(step, 0),
+            'throughput_rps': len(timings) / wall_seconds,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+        }
+    sql_per_request = {}
+    for endpoint, (statements, count) in sql_after.items():
+        old_statements, old_count = sql_before.get(endpoint, (0, 0))
+        if count > old_count:
+            sql_per_request[endpoint] = (statements - old_statements) / (count - old_count)
+    total = sum(len(timings) for timings in recorder.timings.values())
+    return {
+        'total': {'requests': total, 'errors': sum(recorder.errors.values()),
+                  'seconds': wall_seconds, 'throughput_rps': total / wall_seconds},
+        'steps': steps,
+        'sql_per_request': sql_per_request,
+    }
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for step, stats in results['steps'].items():
+        old = baseline.get('steps', {}).get(step)
+        if old and stats['p95_ms'] > old['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{step}: p95 {old['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--users', type=int, default=10, help='одновременных пользователей')
+    parser.add_argument('--iterations', type=int, default=5, help='повторов сценария на пользователя')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='куда сохранить результаты (JSON)')
+    parser.add_argument('--baseline', help='результаты прошлого запуска для сравнения')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='допустимый рост p95, доля')
+    args = parser.parse_args()
+    base_url = args.base_url.rstrip('/')
+
+    recorder = Recorder()
+    sql_before = scrape_sql_counts(base_url)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        futures = [executor.submit(simulate_user, base_url, args.iterations, recorder, random.Random(args.seed + user))
+                   for user in range(args.users)]
+        for future in futures:
+            future.result()
+    results = summarize(recorder, time.perf_counter() - started, sql_before, scrape_sql_counts(base_url))
+    results['config'] = {'users': args.users, 'iterations': args.iterations, 'seed': args.seed, 'base_url': base_url}
+
+    print(f"{'step':<15}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for step, stats in results['steps'].items():
+        print(f"{step:<15}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+    total = results['total']
+    print(f"total: {total['requests']} requests, {total['errors']} errors, {total['throughput_rps']:.1f} req/s")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.max_regression)
+        if regressions:
+            print('Regressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
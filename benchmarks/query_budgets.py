@@ -0,0 +1,173 @@
+"""Проверка бюджетов SQL-запросов по маршрутам (@query_budget в routes.py).
+
+Прогоняет сценарий покупателя через тестовый клиент Flask дважды: с маленькими данными (одна книга
+в корзине и заказе, один отзыв) и с большими (--size книг и отзывов), и считает SQL-запросы на
+каждый запрос к приложению через события SQLAlchemy. Скрипт завершается с кодом 1, если маршрут
+превысил свой бюджет или если число его запросов выросло вместе с объемом данных (N+1). Для маршрутов
+из EXACT_BUDGETS число запросов должно совпадать с бюджетом. Перед каждым запросом кэш версии каталога
+сбрасывается, поэтому маршруты под @conditional каждый раз выполняют и ее чтение (version_read).
+
+Добавляет в базу DATABASE_URL тестовые книги, пользователей и заказы, поэтому запускать его нужно
+на локальной базе разработки:
+
+    python benchmarks/query_budgets.py --size 25
+"""
+import argparse
+import os
+import re
+import sys
+import uuid
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# дешевое хеширование в процессе: проверяются запросы к БД, а не скорость scrypt
+os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+# загрузка пользователя (load_user) входит в каждый подсчет, а не только в промах кэша
+os.environ.setdefault('USER_CACHE_TTL', '0')
+
+from sqlalchemy import event
+
+from app import app
+from db.catalog_import import import_books
+from db.catalog_version import reset_cache
+from db.database import engine, init_db, session_scope
+from db.models import Book, Order, Review, User
+
+CART_ITEM_RE = re.compile(r'name="for_order" value="(\d+)"')
+# раздел каталога загружается одним запросом с проекцией (и чтением версии каталога): лишний запрос
+# в пределах бюджета тоже считается ошибкой
+EXACT_BUDGETS = {('GET', 'main.get_catalog_section')}
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def _seed(tag, size):
+    """Книги и отзывы к первой из них, возвращает id книг."""
+    import_books([{'title': f'Бюджет {tag} {number}', 'author': f'Автор {tag}', 'year': 2000,
+                   'price': 100 + number, 'genre': 'Роман', 'rating': 4.0} for number in range(size)])
+    with session_scope() as session:
+        book_ids = [book_id for book_id, in session.query(Book.id).filter(Book.author == f'Автор {tag}').order_by(Book.id)]
+        reviewers = [User(username=f'r_{tag}_{number}', email=f'r_{tag}_{number}@example.com', password_hash='-')
+                     for number in range(size)]
+        session.add_all(reviewers)
+        session.flush()
+        session.add_all(Review(user_id=user.id, book_id=book_ids[0], review='Отзыв', rating=5) for user in reviewers)
+    return book_ids
+
+
+def run_scenario(size, counter):
+    """Возвращает {(метод, маршрут): наибольшее число SQL-запросов}."""
+    tag = uuid.uuid4().hex[:8]
+    book_ids = _seed(tag, size)
+    client = app.test_client()
+    counts = defaultdict(int)
+
+    def call(method, url, **kwargs):
+        # чтение версии каталога для ETag входит в каждый подсчет, а не только в промах кэша
+        reset_cache()
+        counter.count = 0
+        response = client.open(url, method=method, **kwargs)
+        if response.status_code >= 500:
+            raise RuntimeError(f'{method} {url}: {response.status_code}')
+        endpoint = app.url_map.bind('localhost').match(url.split('?')[0], method=method)[0]
+        counts[method, endpoint] = max(counts[method, endpoint], counter.count)
+        return response
+
+    password = 'budget-password'
+    call('GET', '/')
+    call('GET', '/catalog/Художественная литература')
+    call('GET', f'/find_book?text=Бюджет {tag}')
+    call('GET', f'/book/{book_ids[0]}')
+    # анонимная корзина в сессии переносится в БД при регистрации, а собранная после нее - при входе
+    for book_id in book_ids:
+        call('GET', f'/add_to_cart/{book_id}')
+    call('GET', f'/book/{book_ids[0]}')
+    call('POST', '/update_cart', data={'item_id': book_ids[0], 'new_count_item': 2})
+    response = call('GET', '/cart')
+    call('GET', f'/delete_item/{book_ids[-1]}')
+    call('GET', f'/add_to_cart/{book_ids[-1]}')
+    call('POST', '/cart', data={'for_order': CART_ITEM_RE.findall(response.get_data(as_text=True))})
+    call('POST', '/register', data={'username': f'b_{tag}', 'email': f'b_{tag}@example.com',
+                                    'phone_number': str(9000000000 + int(tag, 16) % 999999999),
+                                    'password': password, 'confirm_password': password})
+    for book_id in book_ids:
+        call('GET', f'/add_to_cart/{book_id}')
+    call('POST', '/login', data={'email': f'b_{tag}@example.com', 'password': password})
+    # страницы для вошедшего пользователя не кэшируются по ETag, но загружают его
+    call('GET', '/')
+    call('GET', '/catalog/Художественная литература')
+    call('GET', f'/find_book?text=Бюджет {tag}')
+    call('GET', f'/book/{book_ids[0]}')
+    call('POST', f'/book/{book_ids[0]}', data={'rating': '4', 'text': 'Проверка'})
+    for book_id in book_ids:
+        call('GET', f'/add_to_cart/{book_id}')
+    # корзина в БД: позиции меняются и удаляются по id позиции
+    response = call('GET', '/cart')
+    item_ids = CART_ITEM_RE.findall(response.get_data(as_text=True))
+    call('POST', '/update_cart', data={'item_id': item_ids[0], 'new_count_item': 7})
+    call('GET', f'/delete_item/{item_ids[-1]}')
+    call('GET', f'/add_to_cart/{book_ids[-1]}')
+    response = call('GET', '/cart')
+    call('POST', '/cart', data={'for_order': CART_ITEM_RE.findall(response.get_data(as_text=True))})
+    call('GET', '/create_order')
+    # повторное оформление удаляет прежний неподтвержденный заказ
+    for _ in range(2):
+        call('POST', '/create_order', data={'recipient': 'Бюджет', 'phone_number': '9000000000',
+                                            'delivery': 'Курьер', 'address': 'Адрес', 'payment': 'Карта'})
+    call('GET', '/confirm_order')
+    call('POST', '/confirm_order', data={'confirm': 'Подтвержден'})
+    call('GET', '/user_orders')
+    with session_scope() as session:
+        user = session.query(User).filter_by(username=f'b_{tag}').one()
+        order_id = user.orders[-1].id
+        # самый старый вид заказа: только Order.books, без order_lines и details['items']
+        legacy_order = Order(user_id=user.id, status='Выполнен', address='Адрес',
+                             books={str(book_id): 1 for book_id in book_ids}, details={'total': 0})
+        session.add(legacy_order)
+        session.flush()
+        legacy_order_id = legacy_order.id
+    call('GET', f'/get_order/{order_id}')
+    call('GET', f'/get_order/{legacy_order_id}')
+    call('GET', f'/cancel_order/{order_id}')
+    call('GET', '/logout')
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=25, help='книг в корзине и отзывов в большом прогоне')
+    args = parser.parse_args()
+
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    init_db()
+    counter = StatementCounter()
+    small = run_scenario(1, counter)
+    large = run_scenario(args.size, counter)
+
+    failures = []
+    print(f"{'route':<32}{'budget':>8}{'size 1':>8}{f'size {args.size}':>10}")
+    for method, endpoint in sorted(large):
+        budget = getattr(app.view_functions[endpoint], 'query_budget', None)
+        small_count, large_count = small.get((method, endpoint), 0), large[method, endpoint]
+        print(f"{method + ' ' + endpoint:<32}{'-' if budget is None else budget:>8}{small_count:>8}{large_count:>10}")
+        if budget is not None and large_count > budget:
+            failures.append(f'{method} {endpoint}: {large_count} запросов при бюджете {budget}')
+        elif (method, endpoint) in EXACT_BUDGETS and large_count != budget:
+            failures.append(f'{method} {endpoint}: {large_count} запросов, ожидается ровно {budget}')
+        if large_count > small_count:
+            failures.append(f'{method} {endpoint}: число запросов растет с объемом данных ({small_count} -> {large_count})')
+    if failures:
+        print('Failures:\n  ' + '\n  '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,32 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     DATABASE_URL : str
     SECRET_KEY : str
+    DB_POOL_SIZE : int = 5
+    DB_MAX_OVERFLOW : int = 10
+    DB_POOL_TIMEOUT : int = 30
+    DB_POOL_RECYCLE : int = 1800
+    DB_POOL_PRE_PING : bool = True
+    DB_STATEMENT_TIMEOUT_MS : int = 0
+    DB_PGBOUNCER : bool = False
+    DB_DIRECT_URL : str = ''
+    CATALOG_PAGE_SIZE : int = 24
+    TOP_BOOKS_COUNT : int = 3
+    REVIEWS_PAGE_SIZE : int = 20
+    USER_CACHE_TTL : int = 60
+    USER_CACHE_SIZE : int = 10000
+    ASYNC_MAX_REQUESTS : int = 500
+    CATALOG_VERSION_TTL : int = 5
+    HTTP_CACHE_MAX_AGE : int = 60
+    SEARCH_CANDIDATES : int = 1000
+    COVERS_DIR : str = 'covers'
+    COVER_INGEST_WORKERS : int = 0
+    PASSWORD_HASH_METHOD : str = 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS : int = 2
+    PASSWORD_HASH_QUEUE : int = 32
+    USER_FILTER_CAPACITY : int = 1000000
+    USER_FILTER_ERROR_RATE : float = 0.01
+    SQL_BUDGET_STRICT : bool = False
+    SESSION_CART_MAX_BOOKS : int = 50
 
 
 settings = Settings()
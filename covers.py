@@ -0,0 +1,92 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from flask import url_for
+from sqlalchemy import Integer, String, column, update, values
+
+from config import settings
+from db.catalog_version import bump_catalog_version
+from db.database import session_scope
+from db.leaderboard import rebuild_leaderboard
+from db.models import Book
+from static_images import Image, ImageOps, SOURCE_EXTENSIONS, encode_image, send_immutable, write_file
+
+# thumb - карточки каталога, корзина и главная (блоки 100x150 и 200x300), detail - страница книги
+RENDITIONS = {'thumb': (200, 300), 'detail': (400, 600)}
+COVERS_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), settings.COVERS_DIR)
+
+
+def _store(data):
+    # файл называется хешем содержимого: одинаковые обложки хранятся один раз, адрес меняется вместе с картинкой
+    digest = hashlib.sha256(data).hexdigest()
+    relative_path = f'{digest[:2]}/{digest}.webp'
+    target = os.path.join(COVERS_ROOT, relative_path)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        write_file(target, data)
+    return relative_path
+
+
+def render_cover(task):
+    """Выполняется в процессе пула: (book_id, путь к файлу) -> (book_id, путь thumb, путь detail) или None."""
+    book_id, path = task
+    try:
+        with Image.open(path) as original:
+            original = ImageOps.exif_transpose(original).convert('RGB')
+            paths = [_store(encode_image(ImageOps.fit(original, size, Image.Resampling.LANCZOS), 'webp'))
+                     for size in RENDITIONS.values()]
+    except OSError:
+        return None
+    return (book_id, *paths)
+
+
+def find_covers(directory):
+    """Файлы обложек в каталоге: имя файла - id книги (например 42.jpg)."""
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        if stem.isdigit() and extension.lower() in SOURCE_EXTENSIONS:
+            yield int(stem), os.path.join(directory, name)
+
+
+def ingest_covers(tasks, workers=None, batch_size=500):
+    """Готовит обложки в пуле процессов и записывает пути к ним в books пачками по batch_size.
+
+    Возвращает статистику: {'files', 'books', 'failed', 'seconds'}.
+    """
+    started = time.perf_counter()
+    stats = {'files': 0, 'books': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers or settings.COVER_INGEST_WORKERS or None) as pool:
+        results = pool.map(render_cover, tasks, chunksize=16)
+        while batch := list(islice(results, batch_size)):
+            rendered = [result for result in batch if result is not None]
+            stats['files'] += len(batch)
+            stats['failed'] += len(batch) - len(rendered)
+            if not rendered:
+                continue
+            covers = values(column('book_id', Integer), column('thumb', String), column('detail', String),
+                            name='covers').data(rendered)
+            with session_scope() as session:
+                result = session.execute(update(Book).where(Book.id == covers.c.book_id)
+                                         .values(cover_thumb=covers.c.thumb, cover_detail=covers.c.detail),
+                                         execution_options={'synchronize_session': False})
+                stats['books'] += result.rowcount
+    with session_scope() as session:
+        # в лидерах продаж хранится копия обложки
+        rebuild_leaderboard(session)
+        bump_catalog_version(session)
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def cover_url(book, rendition='thumb'):
+    """Адрес обложки нужного размера; для книг без подготовленных обложек - исходный Book.cover."""
+    path = getattr(book, f'cover_{rendition}', None)
+    return url_for('covers', filename=path) if path else book.cover
+
+
+def init_covers(app):
+    app.add_url_rule('/covers/<path:filename>', 'covers', lambda filename: send_immutable(COVERS_ROOT, filename))
+    app.jinja_env.globals.update(cover_url=cover_url)
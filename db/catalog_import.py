@@ -0,0 +1,114 @@
+import csv
+import io
+import json
+import time
+from itertools import islice
+
+from psycopg2 import extensions
+from sqlalchemy import Column, MetaData, Table, or_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from db.database import engine, session_scope
+from db.leaderboard import rebuild_leaderboard
+from db.catalog_version import bump_catalog_version
+from db.models import BOOK_KEY_COALESCED, Book, coalesced_book_key, nulls_not_distinct_supported
+
+BOOK_FIELDS = ('title', 'author', 'year', 'price', 'genre', 'cover', 'description', 'rating')
+NATURAL_KEY = ('title', 'author', 'year')
+# счетчики магазина (orders_count) не загружаются, при повторной загрузке обновляются только данные каталога
+UPDATABLE_FIELDS = ('price', 'genre', 'cover', 'description')
+CONVERTERS = {'year': int, 'price': float, 'rating': float}
+
+# промежуточная таблица: пачка копируется в нее через COPY и одним запросом переносится в books.
+# Таблица создается в транзакции каждой пачки и удаляется при фиксации: через PgBouncer в режиме
+# transaction следующая транзакция может попасть на другое соединение сервера
+staging = Table(
+    'books_import', MetaData(),
+    *(Column(column.name, column.type) for column in Book.__table__.columns if column.name in BOOK_FIELDS),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP'
+)
+
+
+def _normalize(row):
+    book = []
+    for field in BOOK_FIELDS:
+        value = row.get(field)
+        if value == '':
+            value = None
+        if value is not None and field in CONVERTERS:
+            value = CONVERTERS[field](value)
+        book.append(value)
+    return book
+
+
+def read_books(path):
+    """Читает книги из файла .json, .jsonl или .csv. JSONL и CSV читаются потоково."""
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as file:
+            yield from csv.DictReader(file)
+    elif path.endswith('.json'):
+        with open(path, encoding='utf-8') as file:
+            yield from json.load(file)
+    else:
+        raise ValueError(f'Неизвестный формат файла: {path}')
+
+
+def _upsert_statement(dialect):
+    # ключ книги - ограничение с NULLS NOT DISTINCT или, до PostgreSQL 15, индекс uq_books_key_coalesced
+    if nulls_not_distinct_supported(dialect):
+        staging_key = [staging.c[field] for field in NATURAL_KEY]
+        conflict = {'constraint': 'uq_books_title_author_year'}
+    else:
+        staging_key = coalesced_book_key(*(staging.c[field] for field in NATURAL_KEY))
+        conflict = {'index_elements': list(BOOK_KEY_COALESCED)}
+    # DISTINCT ON: в одной пачке ключ должен встречаться один раз, иначе ON CONFLICT упадет
+    rows = select(*(staging.c[field] for field in BOOK_FIELDS)).distinct(*staging_key)
+    stmt = insert(Book).from_select(BOOK_FIELDS, rows)
+    # неизменившиеся книги не перезаписываются: новая версия строки обновляла бы все индексы books
+    changed = or_(*(Book.__table__.c[field].is_distinct_from(stmt.excluded[field]) for field in UPDATABLE_FIELDS))
+    return stmt.on_conflict_do_update(
+        **conflict,
+        set_={field: stmt.excluded[field] for field in UPDATABLE_FIELDS},
+        where=changed
+    )
+
+
+def _copy_batch(connection, batch):
+    if extensions.get_wait_callback() is not None:
+        # в асинхронном режиме (serve_async.py) psycopg2 не поддерживает COPY
+        connection.execute(staging.insert(), [dict(zip(BOOK_FIELDS, row)) for row in batch])
+        return
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(batch)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {staging.name} ({', '.join(BOOK_FIELDS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def import_books(rows, batch_size=5000):
+    """Загружает книги пачками с upsert по (title, author, year), повторный запуск не создает дублей."""
+    rows = iter(rows)
+    total = 0
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        stmt = _upsert_statement(connection.dialect)
+        while True:
+            batch = [_normalize(row) for row in islice(rows, batch_size)]
+            if not batch:
+                break
+            with connection.begin():
+                staging.create(connection)
+                _copy_batch(connection, batch)
+                connection.execute(stmt)
+            total += len(batch)
+    with session_scope() as session:
+        rebuild_leaderboard(session)
+        bump_catalog_version(session)
+    seconds = time.perf_counter() - started
+    return {'rows': total, 'seconds': seconds, 'rows_per_sec': total / seconds if seconds else 0.0}
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+
+from config import settings
+from db.database import session_scope
+from db.models import CatalogVersion, sales_version
+
+_cached = None
+_cached_until = 0.0
+_lock = threading.Lock()
+
+# до первого nextval last_value уже равен 1, поэтому учитывается и is_called
+SALES_VERSION = literal_column('(SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM sales_version)')
+
+
+def reset_cache():
+    """Следующий catalog_version() прочитает версии из БД."""
+    global _cached
+    with _lock:
+        _cached = None
+
+
+def bump_catalog_version(session):
+    """Отмечает изменение каталога (книги, обложки, отзывы и рейтинги) в текущей транзакции."""
+    stmt = insert(CatalogVersion).values(id=1, version=1, updated_at=func.now())
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[CatalogVersion.id],
+        set_={'version': CatalogVersion.version + 1, 'updated_at': func.now()}
+    ))
+    reset_cache()
+
+
+def bump_sales_version():
+    """Отмечает изменение продаж (подтверждение или отмена заказа, пересчет продаж).
+
+    Вызывается после фиксации транзакции заказа: nextval не откатывается и виден сразу, и увеличенная
+    раньше фиксации версия могла бы закрепить в кэше клиентов страницу без этой продажи.
+    """
+    with session_scope() as session:
+        session.execute(select(sales_version.next_value()))
+    reset_cache()
+
+
+def catalog_version():
+    """(версия каталога, время ее изменения, версия продаж); из БД читается не чаще раза в CATALOG_VERSION_TTL секунд."""
+    global _cached, _cached_until
+    with _lock:
+        if _cached is not None and time.monotonic() < _cached_until:
+            return _cached
+    with session_scope() as session:
+        query = session.query(CatalogVersion.version, CatalogVersion.updated_at,
+                              SALES_VERSION.label('sales_version')).filter_by(id=1)
+        row = query.first()
+        if row is None:
+            bump_catalog_version(session)
+            row = query.first()
+    with _lock:
+        _cached = (row.version, row.updated_at.replace(microsecond=0), row.sales_version)
+        _cached_until = time.monotonic() + settings.CATALOG_VERSION_TTL
+        return _cached
@@ -1,14 +1,112 @@
-from sqlalchemy import create_engine
+import threading
+import time
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
-from db.models import Base
+from sqlalchemy.pool import NullPool, QueuePool
+from db.models import Base, BookSalesDay, TopBook
+from db.leaderboard import rebuild_leaderboard
+from db.sales import rebuild_sales
+from db.user_uniqueness import user_filter
+from db.migrations import migrate, pending_migrations
 from config import settings
 from contextlib import contextmanager
 
-engine = create_engine(settings.DATABASE_URL)
+
+class TimedQueuePool(QueuePool):
+    # QueuePool, который запоминает, сколько запросы ждали свободное соединение
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.waits += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+connect_args = {}
+if settings.DB_STATEMENT_TIMEOUT_MS and not settings.DB_PGBOUNCER:
+    connect_args['options'] = f'-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}'
+
+engine = create_engine(
+    settings.DATABASE_URL,
+    poolclass=TimedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    connect_args=connect_args,
+)
 SessionLocal = scoped_session(session_factory=sessionmaker(autocommit=False, bind=engine))
 
+if settings.DB_STATEMENT_TIMEOUT_MS and settings.DB_PGBOUNCER:
+    # PgBouncer в режиме transaction не пропускает параметры запуска и делит сессии между клиентами,
+    # поэтому ограничение задается внутри каждой транзакции
+    @event.listens_for(engine, 'begin')
+    def _set_statement_timeout(connection):
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {settings.DB_STATEMENT_TIMEOUT_MS}')
+
+
+def pool_status():
+    pool = engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'waits': pool.waits,
+        'wait_seconds_total': pool.wait_seconds_total,
+        'wait_seconds_max': pool.wait_seconds_max,
+    }
+
+
+def migrations_available():
+    # миграции держат сессионные pg_advisory_lock и SET statement_timeout: через PgBouncer в режиме
+    # transaction они могут выполниться на разных соединениях сервера, и блокировка останется висеть
+    return not settings.DB_PGBOUNCER or bool(settings.DB_DIRECT_URL)
+
+
+def _migrate():
+    if not settings.DB_PGBOUNCER:
+        return migrate(engine)
+    if not settings.DB_DIRECT_URL:
+        pending = pending_migrations(engine)
+        if pending:
+            raise RuntimeError(f"Не применены миграции {', '.join(map(str, pending))}: через PgBouncer они не "
+                               f"выполняются, примените их командой flask db-migrate с DB_DIRECT_URL")
+        return []
+    direct_engine = create_engine(settings.DB_DIRECT_URL, poolclass=NullPool)
+    try:
+        return migrate(direct_engine)
+    finally:
+        direct_engine.dispose()
+
+
 def init_db():
+    """Создает недостающие таблицы, применяет миграции (db/migrations.py) и возвращает номера примененных.
+
+    При DB_PGBOUNCER миграции идут через прямое подключение DB_DIRECT_URL, а без него пропускаются.
+    """
     Base.metadata.create_all(bind=engine)
+    applied = _migrate()
+    with session_scope() as session:
+        if session.query(TopBook).first() is None:
+            rebuild_leaderboard(session)
+        if session.query(BookSalesDay).first() is None:
+            rebuild_sales(session)
+        user_filter.ensure_built(session)
+    return applied
 
 @contextmanager
 def session_scope():
@@ -20,4 +118,4 @@ def session_scope():
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
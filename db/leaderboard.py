@@ -0,0 +1,59 @@
+from sqlalchemy import delete, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from config import settings
+from db.models import Book, TopBook
+
+BOOK_COLUMNS = (Book.id, Book.orders_count, Book.title, Book.author, Book.year, Book.cover,
+                Book.cover_thumb)
+TOP_BOOK_COLUMNS = ('scope', 'book_id', 'orders_count', 'title', 'author', 'year', 'cover', 'cover_thumb')
+
+
+def _trim(session):
+    # в каждом разделе остаются только первые TOP_BOOKS_COUNT книг
+    ranked = select(
+        TopBook.scope, TopBook.book_id,
+        func.row_number().over(partition_by=TopBook.scope,
+                               order_by=(TopBook.orders_count.desc(), TopBook.book_id)).label('place')
+    ).subquery()
+    extra = select(ranked.c.scope, ranked.c.book_id).where(ranked.c.place > settings.TOP_BOOKS_COUNT)
+    session.execute(delete(TopBook).where(tuple_(TopBook.scope, TopBook.book_id).in_(extra)))
+
+
+def update_leaderboard(session, book_ids):
+    """Обновляет лидеров после изменения orders_count у книг book_ids, в той же транзакции."""
+    if not book_ids:
+        return
+    session.flush()
+    sold = select(literal('').label('scope'), *BOOK_COLUMNS).where(Book.id.in_(book_ids)).union_all(
+        select(Book.genre, *BOOK_COLUMNS).where(Book.id.in_(book_ids), Book.genre.is_not(None)))
+    stmt = insert(TopBook).from_select(TOP_BOOK_COLUMNS, sold)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[TopBook.scope, TopBook.book_id],
+        set_={column: stmt.excluded[column] for column in TOP_BOOK_COLUMNS[2:]}
+    ))
+    _trim(session)
+
+
+def rebuild_leaderboard(session):
+    """Пересчитывает лидеров по всему каталогу (после загрузки книг или при первом запуске)."""
+    session.execute(delete(TopBook))
+    ranked_books = select(literal('').label('scope'), *BOOK_COLUMNS).union_all(
+        select(Book.genre, *BOOK_COLUMNS).where(Book.genre.is_not(None))).subquery()
+    ranked = select(
+        *ranked_books.c,
+        func.row_number().over(partition_by=ranked_books.c.scope,
+                               order_by=(ranked_books.c.orders_count.desc(), ranked_books.c.id)).label('place')
+    ).subquery()
+    rows = select(*(ranked.c[column] for column in ('scope', 'id', *TOP_BOOK_COLUMNS[2:]))
+                  ).where(ranked.c.place <= settings.TOP_BOOKS_COUNT)
+    session.execute(insert(TopBook).from_select(TOP_BOOK_COLUMNS, rows))
+
+
+def get_top_books(session, genre=None):
+    return (session.query(TopBook.book_id, TopBook.orders_count, TopBook.title, TopBook.author,
+                          TopBook.year, TopBook.cover, TopBook.cover_thumb)
+            .filter(TopBook.scope == (genre or ''))
+            .order_by(TopBook.orders_count.desc(), TopBook.book_id)
+            .limit(settings.TOP_BOOKS_COUNT)
+            .all())
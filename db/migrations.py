@@ -0,0 +1,289 @@
+"""Версионные миграции схемы для уже существующих баз.
+
+create_all создает только отсутствующие таблицы, поэтому колонки и индексы, добавленные в
+существующие таблицы, переносятся сюда. Каждая миграция выполняется один раз, ее номер
+записывается в schema_version. Индексы строятся через CREATE INDEX CONCURRENTLY, без блокировки
+записи в таблицу, поэтому миграции можно применять к работающему магазину (flask db-migrate).
+Исключение - миграция 1: добавление вычисляемой колонки search_vector перезаписывает таблицу books
+под блокировкой ACCESS EXCLUSIVE, и чтение каталога ждет ее окончания (на миллионе книг - минуты).
+Ее нужно применять в окно обслуживания; остальные миграции блокируют только изменяемые строки.
+Все шаги идемпотентны: на новой базе, созданной create_all, они ничего не меняют.
+"""
+from collections import namedtuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from db.leaderboard import rebuild_leaderboard
+from db.models import nulls_not_distinct_supported
+from db.ratings import rebuild_ratings
+
+# ключ pg_advisory_lock: миграции из нескольких процессов выполняются по очереди
+MIGRATIONS_LOCK_ID = 0x626f6f6b
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String),
+    Column('applied_at', DateTime(timezone=True), server_default=func.now()),
+)
+
+# when - условие по диалекту (версии сервера), при котором индекс нужен; None - всегда
+ConcurrentIndex = namedtuple('ConcurrentIndex', 'name table columns unique using nulls_not_distinct when',
+                             defaults=(False, 'btree', False, None))
+# ключ книги для PostgreSQL до 15, как BOOK_KEY_COALESCED в db/models.py
+BOOK_KEY_COALESCED = "coalesce(title, ''), coalesce(author, ''), coalesce(year, 0)"
+
+
+def _nulls_distinct_only(dialect):
+    return not nulls_not_distinct_supported(dialect)
+
+
+def _add_columns(connection):
+    # колонки, добавленные в существующие таблицы books и top_books. Вычисляемая search_vector
+    # заполняется перезаписью всей таблицы books под ACCESS EXCLUSIVE: на это время каталог недоступен
+    for table, column, definition in (
+        ('books', 'rating_sum', 'integer DEFAULT 0'),
+        ('books', 'rating_1', 'integer DEFAULT 0'),
+        ('books', 'rating_2', 'integer DEFAULT 0'),
+        ('books', 'rating_3', 'integer DEFAULT 0'),
+        ('books', 'rating_4', 'integer DEFAULT 0'),
+        ('books', 'rating_5', 'integer DEFAULT 0'),
+        ('books', 'search_vector', "tsvector GENERATED ALWAYS AS "
+                                   "(to_tsvector('russian', coalesce(title, '') || ' ' || coalesce(author, ''))) STORED"),
+        ('books', 'cover_thumb', 'varchar'),
+        ('books', 'cover_detail', 'varchar'),
+        ('top_books', 'cover_thumb', 'varchar'),
+    ):
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}'))
+
+
+def _deduplicate_books(connection):
+    # до уникального индекса по (title, author, year): старый /valera добавлял весь каталог при каждом
+    # вызове, а книги с NULL в ключе дублировались и при загрузке каталога. Копиями считаются книги
+    # с одинаковым ключом, включая NULL; остается книга с меньшим id, ссылки на копии переносятся на нее.
+    # До PostgreSQL 15 ключ - выражения индекса uq_books_key_coalesced: NULL равен пустому значению
+    key = 'title, author, year' if nulls_not_distinct_supported(connection.dialect) else BOOK_KEY_COALESCED
+    connection.execute(text(f"""
+        CREATE TEMPORARY TABLE book_duplicates ON COMMIT DROP AS
+        SELECT book_id, keep_id FROM (
+            SELECT id AS book_id, min(id) OVER same_book AS keep_id, count(*) OVER same_book AS copies
+            FROM books WINDOW same_book AS (PARTITION BY {key})
+        ) books WHERE copies > 1
+    """))
+    if connection.execute(text('SELECT count(*) FROM book_duplicates')).scalar() == 0:
+        return
+    # из отзывов пользователя на копии одной книги остается последний, в корзине количества складываются
+    connection.execute(text("""
+        DELETE FROM reviews USING book_duplicates copy, reviews newer, book_duplicates newer_copy
+        WHERE reviews.book_id = copy.book_id AND newer.book_id = newer_copy.book_id
+          AND newer_copy.keep_id = copy.keep_id AND newer.user_id = reviews.user_id AND newer.id > reviews.id
+    """))
+    connection.execute(text("""
+        WITH merged AS (
+            SELECT min(cart_items.id) AS id, cart_items.user_id, copy.keep_id, sum(coalesce(cart_items.count, 1)) AS count
+            FROM cart_items JOIN book_duplicates copy ON copy.book_id = cart_items.book_id
+            GROUP BY cart_items.user_id, copy.keep_id
+        ), updated AS (
+            UPDATE cart_items SET count = merged.count FROM merged WHERE cart_items.id = merged.id
+        )
+        DELETE FROM cart_items USING book_duplicates copy, merged
+        WHERE cart_items.book_id = copy.book_id AND copy.keep_id = merged.keep_id
+          AND cart_items.user_id = merged.user_id AND cart_items.id <> merged.id
+    """))
+    for table in ('reviews', 'cart_items', 'order_lines', 'order_items'):
+        connection.execute(text(f"""
+            UPDATE {table} SET book_id = copy.keep_id FROM book_duplicates copy
+            WHERE {table}.book_id = copy.book_id AND copy.book_id <> copy.keep_id
+        """))
+    # старые заказы хранят id книг в books ({id: количество}) и details['items']
+    connection.execute(text("""
+        UPDATE orders SET books = (
+            SELECT jsonb_object_agg(book_id, count) FROM (
+                SELECT coalesce(copy.keep_id::text, entry.key) AS book_id, sum(entry.value::integer) AS count
+                FROM jsonb_each_text(orders.books) entry
+                LEFT JOIN book_duplicates copy ON copy.book_id::text = entry.key AND copy.book_id <> copy.keep_id
+                GROUP BY 1
+            ) merged_books
+        )
+        WHERE jsonb_typeof(orders.books) = 'object'
+          AND orders.books ?| ARRAY(SELECT book_id::text FROM book_duplicates WHERE book_id <> keep_id)
+    """))
+    connection.execute(text("""
+        UPDATE orders SET details = jsonb_set(orders.details, '{items}', (
+            SELECT jsonb_agg(CASE WHEN copy.keep_id IS NULL THEN item.value
+                                  ELSE jsonb_set(item.value, '{book_id}', to_jsonb(copy.keep_id)) END
+                             ORDER BY item.position)
+            FROM jsonb_array_elements(orders.details -> 'items') WITH ORDINALITY AS item(value, position)
+            LEFT JOIN book_duplicates copy
+                   ON copy.book_id::text = item.value ->> 'book_id' AND copy.book_id <> copy.keep_id
+        ))
+        WHERE jsonb_typeof(orders.details -> 'items') = 'array' AND EXISTS (
+            SELECT 1 FROM jsonb_array_elements(orders.details -> 'items') item
+            JOIN book_duplicates copy ON copy.book_id::text = item.value ->> 'book_id' AND copy.book_id <> copy.keep_id
+        )
+    """))
+    connection.execute(text("""
+        INSERT INTO book_sales_daily (day, book_id, count)
+        SELECT sales.day, copy.keep_id, sum(sales.count)
+        FROM book_sales_daily sales JOIN book_duplicates copy ON copy.book_id = sales.book_id
+        WHERE copy.book_id <> copy.keep_id
+        GROUP BY sales.day, copy.keep_id
+        ON CONFLICT (day, book_id) DO UPDATE SET count = book_sales_daily.count + excluded.count
+    """))
+    connection.execute(text("""
+        UPDATE books SET orders_count = coalesce(books.orders_count, 0) + copies.orders_count
+        FROM (SELECT copy.keep_id, sum(coalesce(copy_book.orders_count, 0)) AS orders_count
+              FROM book_duplicates copy JOIN books copy_book ON copy_book.id = copy.book_id
+              WHERE copy.book_id <> copy.keep_id GROUP BY copy.keep_id) copies
+        WHERE books.id = copies.keep_id
+    """))
+    for table in ('book_sales_daily', 'top_books'):
+        connection.execute(text(f"""
+            DELETE FROM {table} USING book_duplicates copy
+            WHERE {table}.book_id = copy.book_id AND copy.book_id <> copy.keep_id
+        """))
+    connection.execute(text("""
+        DELETE FROM books USING book_duplicates copy WHERE books.id = copy.book_id AND copy.book_id <> copy.keep_id
+    """))
+    rebuild_ratings(connection)
+    rebuild_leaderboard(connection)
+    # страницы каталога изменились: сохраненные клиентами копии (ETag) больше не действительны
+    connection.execute(text('UPDATE catalog_version SET version = version + 1, updated_at = now()'))
+    connection.execute(text("SELECT nextval('sales_version')"))
+
+
+def _books_unique_constraint(connection):
+    # импорт каталога обращается к ограничению по имени (ON CONFLICT ON CONSTRAINT), индекса недостаточно
+    constraint = connection.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'uq_books_title_author_year'")).first()
+    if constraint is None:
+        connection.execute(text('ALTER TABLE books ADD CONSTRAINT uq_books_title_author_year '
+                                'UNIQUE USING INDEX uq_books_title_author_year'))
+
+
+def _books_key_nulls_not_distinct(connection):
+    # ограничение переводится на индекс, в котором NULL в ключе (книга без года или автора) не уникален.
+    # До PostgreSQL 15 ограничение остается прежним, дубли с NULL ловит uq_books_key_coalesced
+    if not nulls_not_distinct_supported(connection.dialect):
+        return
+    nulls_distinct = connection.execute(text(
+        "SELECT NOT pg_index.indnullsnotdistinct FROM pg_constraint "
+        "JOIN pg_index ON pg_index.indexrelid = pg_constraint.conindid "
+        "WHERE pg_constraint.conname = 'uq_books_title_author_year'")).scalar()
+    if nulls_distinct:
+        connection.execute(text('ALTER TABLE books DROP CONSTRAINT uq_books_title_author_year, '
+                                'ADD CONSTRAINT uq_books_title_author_year UNIQUE USING INDEX uq_books_key_nulls_not_distinct'))
+    else:
+        # база создана уже с таким ограничением (create_all)
+        connection.execute(text('DROP INDEX IF EXISTS uq_books_key_nulls_not_distinct'))
+
+
+def _deduplicate(connection):
+    # перед уникальными индексами: одинаковые книги в корзине объединяются, из отзывов остается последний
+    connection.execute(text("""
+        WITH merged AS (
+            SELECT min(id) AS id, user_id, book_id, sum(coalesce(count, 1)) AS count
+            FROM cart_items GROUP BY user_id, book_id HAVING count(*) > 1
+        ), updated AS (
+            UPDATE cart_items SET count = merged.count FROM merged WHERE cart_items.id = merged.id
+        )
+        DELETE FROM cart_items USING merged
+        WHERE cart_items.user_id = merged.user_id AND cart_items.book_id = merged.book_id AND cart_items.id <> merged.id
+    """))
+    deleted = connection.execute(text("""
+        DELETE FROM reviews USING reviews newer
+        WHERE newer.user_id = reviews.user_id AND newer.book_id = reviews.book_id AND newer.id > reviews.id
+    """)).rowcount
+    if deleted:
+        rebuild_ratings(connection)
+
+
+MIGRATIONS = [
+    # счетчики оценок (db/ratings.py) заполняются по отзывам отдельной транзакцией, уже после снятия
+    # блокировки ALTER TABLE; review_count раньше по умолчанию был 5
+    (1, 'added columns', [_add_columns, rebuild_ratings]),
+    (2, 'catalog indexes', [
+        _deduplicate_books,
+        ConcurrentIndex('uq_books_title_author_year', 'books', 'title, author, year', unique=True),
+        _books_unique_constraint,
+        ConcurrentIndex('ix_books_genre', 'books', 'genre'),
+        ConcurrentIndex('ix_books_search_vector', 'books', 'search_vector', using='gin'),
+        ConcurrentIndex('ix_books_popular_id', 'books', 'coalesce(orders_count, 0), id'),
+        ConcurrentIndex('ix_books_price_id', 'books', 'coalesce(price, 0), id'),
+        ConcurrentIndex('ix_books_rating_id', 'books', 'coalesce(rating, 0), id'),
+        ConcurrentIndex('ix_books_year_id', 'books', 'coalesce(year, 0), id'),
+        ConcurrentIndex('ix_books_title_id', 'books', "coalesce(title, ''), id"),
+        ConcurrentIndex('ix_reviews_book_id_id', 'reviews', 'book_id, id'),
+    ]),
+    (3, 'deduplicate cart items and reviews', [_deduplicate]),
+    (4, 'lookup indexes', [
+        ConcurrentIndex('uq_cart_items_user_id_book_id', 'cart_items', 'user_id, book_id', unique=True),
+        ConcurrentIndex('ix_orders_user_id_status', 'orders', 'user_id, status'),
+        ConcurrentIndex('uq_reviews_user_id_book_id', 'reviews', 'user_id, book_id', unique=True),
+        ConcurrentIndex('ix_order_items_user_id', 'order_items', 'user_id'),
+    ]),
+    (5, 'books key with nulls not distinct', [
+        _deduplicate_books,
+        ConcurrentIndex('uq_books_key_nulls_not_distinct', 'books', 'title, author, year', unique=True,
+                        nulls_not_distinct=True, when=nulls_not_distinct_supported),
+        ConcurrentIndex('uq_books_key_coalesced', 'books', BOOK_KEY_COALESCED, unique=True, when=_nulls_distinct_only),
+        _books_key_nulls_not_distinct,
+    ]),
+]
+
+
+def _create_index(connection, index):
+    # прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, IF NOT EXISTS его бы пропустил
+    invalid = connection.execute(text(
+        'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+        'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'), {'name': index.name}).first()
+    if invalid:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+    unique = 'UNIQUE ' if index.unique else ''
+    nulls = ' NULLS NOT DISTINCT' if index.nulls_not_distinct else ''
+    connection.execute(text(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index.name} '
+                            f'ON {index.table} USING {index.using} ({index.columns}){nulls}'))
+
+
+def pending_migrations(engine):
+    """Номера миграций, которые еще не применены к базе."""
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(schema_version.name):
+            return [version for version, _, _ in MIGRATIONS]
+        applied = set(connection.scalars(select(schema_version.c.version)))
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+def migrate(engine):
+    """Применяет недостающие миграции и возвращает их номера.
+
+    Шаг миграции - ConcurrentIndex (строится вне транзакции) или функция, которая получает соединение
+    и выполняется в отдельной транзакции.
+    """
+    applied_now = []
+    with engine.connect() as connection:
+        # CONCURRENTLY нельзя выполнять внутри транзакции, поэтому соединение в режиме autocommit;
+        # сборка индекса на большой таблице может идти дольше DB_STATEMENT_TIMEOUT_MS
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(text('SET statement_timeout = 0'))
+        connection.execute(select(func.pg_advisory_lock(MIGRATIONS_LOCK_ID)))
+        try:
+            schema_version.create(connection, checkfirst=True)
+            applied = set(connection.scalars(select(schema_version.c.version)))
+            for version, name, steps in MIGRATIONS:
+                if version in applied:
+                    continue
+                for step in steps:
+                    if isinstance(step, ConcurrentIndex):
+                        if step.when is None or step.when(connection.dialect):
+                            _create_index(connection, step)
+                    else:
+                        with engine.begin() as transaction:
+                            transaction.execute(text('SET LOCAL statement_timeout = 0'))
+                            step(transaction)
+                connection.execute(schema_version.insert().values(version=version, name=name))
+                applied_now.append(version)
+        finally:
+            connection.execute(select(func.pg_advisory_unlock(MIGRATIONS_LOCK_ID)))
+            connection.execute(text('RESET statement_timeout'))
+    return applied_now
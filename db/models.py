@@ -1,14 +1,27 @@
 from email.policy import default
 
 from flask_login import UserMixin
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date
-from sqlalchemy.orm import DeclarativeBase, relationship
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, UniqueConstraint, Index, Sequence, func, literal_column, Computed
+from sqlalchemy.orm import DeclarativeBase, relationship, deferred
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from datetime import date
 
 class Base(DeclarativeBase):
     pass
 
+
+def nulls_not_distinct_supported(dialect):
+    """UNIQUE NULLS NOT DISTINCT появился в PostgreSQL 15."""
+    return dialect.server_version_info >= (15,)
+
+
+def _with_nulls_not_distinct(ddl, target, bind, dialect=None, **kw):
+    return nulls_not_distinct_supported(dialect or bind.dialect)
+
+
+def _without_nulls_not_distinct(ddl, target, bind, dialect=None, **kw):
+    return not nulls_not_distinct_supported(dialect or bind.dialect)
+
 class User(Base, UserMixin):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -25,24 +38,107 @@ class User(Base, UserMixin):
 
 class Book(Base):
     __tablename__ = 'books'
+    __table_args__ = (
+        # книги без года или автора тоже не должны дублироваться при повторной загрузке каталога.
+        # До PostgreSQL 15 ограничение пропускает NULL, такие дубли ловит индекс uq_books_key_coalesced
+        UniqueConstraint('title', 'author', 'year', name='uq_books_title_author_year',
+                         postgresql_nulls_not_distinct=True).ddl_if(callable_=_with_nulls_not_distinct),
+        UniqueConstraint('title', 'author', 'year', name='uq_books_title_author_year'
+                         ).ddl_if(callable_=_without_nulls_not_distinct),
+        Index('ix_books_search_vector', 'search_vector', postgresql_using='gin'),
+    )
     id = Column(Integer, primary_key=True)
     title = Column(String)
     author = Column(String)
     year = Column(Integer)
     price = Column(Float)
-    genre = Column(String)
+    genre = Column(String, index=True)
     cover = Column(String)
+    # пути к уменьшенным обложкам в хранилище covers.py (thumb - для карточек, detail - для страницы книги)
+    cover_thumb = Column(String)
+    cover_detail = Column(String)
     description = Column(String)
     rating = Column(Float)
-    review_count = Column(Integer, default=5)
+    review_count = Column(Integer, default=0)
+    # сумма оценок и гистограмма по звездам, обновляются в db/ratings.py
+    rating_sum = Column(Integer, default=0)
+    rating_1 = Column(Integer, default=0)
+    rating_2 = Column(Integer, default=0)
+    rating_3 = Column(Integer, default=0)
+    rating_4 = Column(Integer, default=0)
+    rating_5 = Column(Integer, default=0)
     orders_count = Column(Integer, default=0)
+    # поисковый индекс по названию и автору с русской морфологией, заполняется самой БД
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "to_tsvector('russian', coalesce(title, '') || ' ' || coalesce(author, ''))", persisted=True)))
 
     cart_items = relationship('CartItem', back_populates='book')
     reviews = relationship('Review', back_populates='book')
 
 
+# ключ книги для PostgreSQL до 15: NULL в ключе равен пустой строке (году 0), и уникальный индекс
+# по этим выражениям не пропускает дубли книг без года или автора
+def coalesced_book_key(title, author, year):
+    return (func.coalesce(title, literal_column("''")), func.coalesce(author, literal_column("''")),
+            func.coalesce(year, literal_column('0')))
+
+
+BOOK_KEY_COALESCED = coalesced_book_key(Book.title, Book.author, Book.year)
+Index('uq_books_key_coalesced', *BOOK_KEY_COALESCED, unique=True).ddl_if(callable_=_without_nulls_not_distinct)
+
+# сортировки каталога: выражение и направление. Под каждую есть индекс (выражение, id),
+# поэтому любая страница постраничного вывода стоит столько же, сколько первая.
+BOOK_SORTS = {
+    'popular': (func.coalesce(Book.orders_count, literal_column('0')), True),
+    'price': (func.coalesce(Book.price, literal_column('0')), False),
+    'rating': (func.coalesce(Book.rating, literal_column('0')), True),
+    'year': (func.coalesce(Book.year, literal_column('0')), True),
+    'title': (func.coalesce(Book.title, literal_column("''")), False),
+}
+for sort_name, (sort_expression, _) in BOOK_SORTS.items():
+    Index(f'ix_books_{sort_name}_id', sort_expression, Book.id)
+
+
+class TopBook(Base):
+    # лидеры продаж: scope '' - весь каталог, иначе жанр. Поля книги скопированы, чтобы главная не читала books
+    __tablename__ = 'top_books'
+    scope = Column(String, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    orders_count = Column(Integer)
+    title = Column(String)
+    author = Column(String)
+    year = Column(Integer)
+    cover = Column(String)
+    cover_thumb = Column(String)
+
+
+class BookSalesDay(Base):
+    # продажи книги за день (по дате заказа): из них считаются лидеры за неделю, месяц и год
+    __tablename__ = 'book_sales_daily'
+    day = Column(Date, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    count = Column(Integer)
+
+
+class CatalogVersion(Base):
+    # одна строка: номер версии каталога (книги, обложки, отзывы) для ETag/Last-Modified, растет при каждом изменении
+    __tablename__ = 'catalog_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+    updated_at = Column(DateTime(timezone=True))
+
+
+# версия продаж для ETag главной и сортировки по популярности: последовательность, а не строка таблицы,
+# чтобы одновременные подтверждения заказов не ждали друг друга на блокировке
+sales_version = Sequence('sales_version', metadata=Base.metadata)
+
+
 class CartItem(Base):
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # одна строка на книгу в корзине пользователя; индекс также обслуживает выборку корзины по user_id
+        Index('uq_cart_items_user_id_book_id', 'user_id', 'book_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     book_id = Column(Integer, ForeignKey('books.id'))
@@ -54,9 +150,12 @@ class CartItem(Base):
 
 class Order(Base):
     __tablename__ = 'orders'
+    __table_args__ = (
+        Index('ix_orders_user_id_status', 'user_id', 'status'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
-    date = Column(Date(), default=date.today())
+    date = Column(Date(), default=date.today)
     status = Column(String, default='Не подтвержден')
     address = Column(String)
     books = Column(JSONB)
@@ -65,10 +164,28 @@ class Order(Base):
     user = relationship('User', back_populates='orders')
 
 
+class OrderLine(Base):
+    # состав заказа с ценой на момент покупки; заменяет Order.books (старые заказы переносит flask backfill-order-lines)
+    __tablename__ = 'order_lines'
+    __table_args__ = (
+        Index('ix_order_lines_order_id', 'order_id'),
+        Index('ix_order_lines_book_id_order_id', 'book_id', 'order_id'),
+        Index('ix_order_lines_user_id_book_id', 'user_id', 'book_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id', ondelete='CASCADE'))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    book_id = Column(Integer, ForeignKey('books.id'))
+    title = Column(String)
+    count = Column(Integer)
+    price = Column(Float)
+    total_price = Column(Float)
+
+
 class OrderItem(Base):
     __tablename__ = 'order_items'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     book_id = Column(Integer)
     title = Column(String)
     count = Column(Integer)
@@ -80,6 +197,11 @@ class OrderItem(Base):
 
 class Review(Base):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        Index('ix_reviews_book_id_id', 'book_id', 'id'),
+        # один отзыв пользователя на книгу
+        Index('uq_reviews_user_id_book_id', 'user_id', 'book_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     book_id = Column(Integer, ForeignKey('books.id'))
@@ -0,0 +1,56 @@
+import time
+
+from sqlalchemy import Float, Integer, Numeric, String, cast, column, exists, func, select, true
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from db.database import session_scope
+from db.models import Book, Order, OrderLine
+
+LINE_COLUMNS = ('order_id', 'user_id', 'book_id', 'title', 'count', 'price', 'total_price')
+
+
+def _lines_from_details(order_ids):
+    # заказы, в details которых сохранен состав с ценами на момент покупки
+    item = func.jsonb_array_elements(Order.details['items']).table_valued(
+        column('value', JSONB), joins_implicitly=True).render_derived()
+    return (select(Order.id, Order.user_id, cast(item.c.value['book_id'].astext, Integer),
+                   cast(item.c.value['title'].astext, String), cast(item.c.value['count'].astext, Integer),
+                   cast(item.c.value['price'].astext, Float), cast(item.c.value['total'].astext, Float))
+            .select_from(Order).join(item, true())
+            .join(Book, Book.id == cast(item.c.value['book_id'].astext, Integer))
+            .where(Order.id.in_(order_ids), ~exists().where(OrderLine.order_id == Order.id)))
+
+
+def _lines_from_books(order_ids):
+    # самые старые заказы хранят только {book_id: count}: цена берется текущая, других данных нет
+    entry = func.jsonb_each_text(Order.books).table_valued('key', 'value', joins_implicitly=True).render_derived()
+    count = cast(entry.c.value, Integer)
+    return (select(Order.id, Order.user_id, Book.id, Book.title, count, Book.price,
+                   cast(func.round(cast(count * Book.price, Numeric), 2), Float))
+            .select_from(Order).join(entry, true())
+            .join(Book, Book.id == cast(entry.c.key, Integer))
+            .where(Order.id.in_(order_ids), Order.details['items'].is_(None),
+                   ~exists().where(OrderLine.order_id == Order.id)))
+
+
+def backfill_order_lines(batch_size=1000):
+    """Переносит состав старых заказов из Order.books/details в order_lines.
+
+    Заказы обрабатываются пачками по id, каждая пачка в своей короткой транзакции без блокировки таблиц.
+    Заказы, у которых строки уже есть, пропускаются, поэтому команду можно прерывать и запускать повторно.
+    """
+    started = time.perf_counter()
+    stats = {'orders': 0, 'lines': 0}
+    last_id = 0
+    while True:
+        with session_scope() as session:
+            order_ids = session.scalars(select(Order.id).where(Order.id > last_id)
+                                        .order_by(Order.id).limit(batch_size)).all()
+            if not order_ids:
+                break
+            last_id = order_ids[-1]
+            for lines in (_lines_from_details(order_ids), _lines_from_books(order_ids)):
+                stats['lines'] += session.execute(insert(OrderLine).from_select(LINE_COLUMNS, lines)).rowcount
+            stats['orders'] += len(order_ids)
+    stats['seconds'] = time.perf_counter() - started
+    return stats
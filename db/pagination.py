@@ -0,0 +1,57 @@
+from itsdangerous import BadData, URLSafeSerializer
+from sqlalchemy import tuple_
+
+from config import settings
+
+# курсор подписан: его значения подставляются в сравнение строк, и подделанный курсор
+# (строка вместо числа, объект) приводил бы к ошибке БД
+_serializer = URLSafeSerializer(settings.SECRET_KEY, salt='keyset-cursor')
+
+
+def encode_cursor(scope, direction, values):
+    return _serializer.dumps([scope, direction, list(values)])
+
+
+def decode_cursor(cursor, scope):
+    try:
+        cursor_scope, direction, values = _serializer.loads(cursor)
+    except (BadData, ValueError, TypeError):
+        return None
+    if cursor_scope != scope or direction not in ('next', 'prev') or not isinstance(values, list):
+        return None
+    return direction, values
+
+
+def keyset_page(query, keys, descending, page_size, cursor=None, scope=''):
+    """Страница выборки без OFFSET: условие по ключу последней показанной строки.
+
+    keys - выражения с метками (label), добавленные в выборку; последний ключ должен быть уникальным.
+    scope - имя сортировки, курсор от другой сортировки игнорируется.
+    Возвращает (rows, next_cursor, prev_cursor).
+    """
+    decoded = decode_cursor(cursor, scope) if cursor else None
+    direction, values = decoded if decoded else ('next', None)
+    if values is not None and len(values) != len(keys):
+        direction, values = 'next', None
+    backwards = direction == 'prev'
+    # для предыдущей страницы идем в обратную сторону и потом разворачиваем результат
+    reverse = descending != backwards
+    if values is not None:
+        row_key, cursor_key = tuple_(*keys), tuple_(*values)
+        query = query.filter(row_key < cursor_key if reverse else row_key > cursor_key)
+    query = query.order_by(*(key.desc() if reverse else key.asc() for key in keys))
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first = [getattr(rows[0], key.name) for key in keys]
+        last = [getattr(rows[-1], key.name) for key in keys]
+        if has_more or backwards:
+            next_cursor = encode_cursor(scope, 'next', last)
+        if (has_more and backwards) or (values is not None and not backwards):
+            prev_cursor = encode_cursor(scope, 'prev', first)
+    return rows, next_cursor, prev_cursor
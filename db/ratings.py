@@ -0,0 +1,60 @@
+from sqlalchemy import Numeric, case, cast, func, select, update
+
+from db.models import Book, Review
+
+RATINGS = range(1, 6)
+
+
+def _histogram_column(rating):
+    return getattr(Book, f'rating_{rating}')
+
+
+def update_book_rating(session, book_id, rating, old_rating=None):
+    """Учитывает новую оценку (или замену old_rating на rating) одним UPDATE.
+
+    Счетчики меняются приращениями на стороне БД, поэтому одновременные отзывы не затирают друг друга.
+    Вызывать в той же транзакции, что и запись Review.
+    """
+    count_delta = 0 if old_rating is not None else 1
+    sum_delta = rating - (old_rating or 0)
+    histogram_delta = {rating: 1}
+    if old_rating is not None:
+        histogram_delta[old_rating] = histogram_delta.get(old_rating, 0) - 1
+    values = {_histogram_column(value): _histogram_column(value) + delta
+              for value, delta in histogram_delta.items() if delta}
+    # в SET справа используются старые значения строки, поэтому новое среднее считаем с учетом приращений
+    values.update({
+        Book.rating_sum: Book.rating_sum + sum_delta,
+        Book.review_count: Book.review_count + count_delta,
+        Book.rating: func.round(cast(Book.rating_sum + sum_delta, Numeric) / (Book.review_count + count_delta), 1),
+    })
+    session.execute(update(Book).where(Book.id == book_id).values(values))
+
+
+def rebuild_ratings(session):
+    """Пересчитывает суммы, количества и гистограммы оценок всех книг по таблице reviews одним запросом.
+
+    У книг без отзывов остается рейтинг из каталога.
+    """
+    totals = (
+        select(
+            Book.id.label('book_id'),
+            func.count(Review.id).label('review_count'),
+            func.coalesce(func.sum(Review.rating), 0).label('rating_sum'),
+            *(func.count(Review.id).filter(Review.rating == value).label(f'rating_{value}') for value in RATINGS)
+        )
+        .outerjoin(Review, Review.book_id == Book.id)
+        .group_by(Book.id)
+        .subquery()
+    )
+    values = {f'rating_{value}': totals.c[f'rating_{value}'] for value in RATINGS}
+    values.update({
+        'review_count': totals.c.review_count,
+        'rating_sum': totals.c.rating_sum,
+        'rating': case(
+            (totals.c.review_count > 0, func.round(cast(totals.c.rating_sum, Numeric) / totals.c.review_count, 1)),
+            else_=Book.rating
+        ),
+    })
+    result = session.execute(update(Book).where(Book.id == totals.c.book_id).values(values))
+    return result.rowcount
@@ -0,0 +1,73 @@
+import threading
+from datetime import date, timedelta
+
+from sqlalchemy import Date, delete, func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from config import settings
+from db.models import Book, BookSalesDay, Order, OrderLine
+
+# статусы заказов, книги из которых считаются проданными
+SOLD_STATUSES = ('Подтвержден', 'Выполнен')
+SALES_WINDOWS = (7, 30, 365)
+WEEK_DAYS = 7
+
+# лидеры недели для главной: ((версия продаж, день), строки)
+_weekly = None
+_weekly_lock = threading.Lock()
+
+
+def record_sales(session, order, sign=1):
+    """Добавляет (sign=1) или вычитает (sign=-1) книги заказа в продажи за день order.date."""
+    sold = (select(literal(order.date, Date), OrderLine.book_id, sign * func.sum(OrderLine.count))
+            .where(OrderLine.order_id == order.id)
+            .group_by(OrderLine.book_id))
+    stmt = insert(BookSalesDay).from_select(['day', 'book_id', 'count'], sold)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[BookSalesDay.day, BookSalesDay.book_id],
+        set_={'count': BookSalesDay.count + stmt.excluded.count}
+    ))
+
+
+def rebuild_sales(session):
+    """Пересчитывает продажи по дням по всем заказам (при первом запуске или после переноса заказов)."""
+    session.execute(delete(BookSalesDay))
+    sold = (select(Order.date, OrderLine.book_id, func.sum(OrderLine.count))
+            .join(Order, Order.id == OrderLine.order_id)
+            .where(Order.status.in_(SOLD_STATUSES), Order.date.is_not(None))
+            .group_by(Order.date, OrderLine.book_id))
+    session.execute(insert(BookSalesDay).from_select(['day', 'book_id', 'count'], sold))
+
+
+def top_sellers(session, days, limit=None):
+    """Самые продаваемые книги за последние days дней (включая сегодня), читает только продажи по дням."""
+    since = date.today() - timedelta(days=days - 1)
+    total = func.sum(BookSalesDay.count)
+    sold = (select(BookSalesDay.book_id, total.label('orders_count'))
+            .where(BookSalesDay.day >= since)
+            .group_by(BookSalesDay.book_id)
+            .having(total > 0)
+            .order_by(total.desc(), BookSalesDay.book_id)
+            .limit(limit or settings.TOP_BOOKS_COUNT)
+            .subquery())
+    return (session.query(sold.c.book_id, sold.c.orders_count, Book.title, Book.author, Book.year,
+                          Book.cover, Book.cover_thumb)
+            .join(Book, Book.id == sold.c.book_id)
+            .order_by(sold.c.orders_count.desc(), sold.c.book_id)
+            .all())
+
+
+def weekly_top(session, sales_version):
+    """Лидеры за последние 7 дней; в процессе хранятся до следующей продажи (sales_version) или нового дня.
+
+    sales_version - версия продаж из catalog_version(), по той же версии строится ETag главной.
+    """
+    global _weekly
+    key = (sales_version, date.today())
+    with _weekly_lock:
+        if _weekly is not None and _weekly[0] == key:
+            return _weekly[1]
+    rows = top_sellers(session, WEEK_DAYS)
+    with _weekly_lock:
+        _weekly = (key, rows)
+    return rows
@@ -0,0 +1,52 @@
+import re
+
+from sqlalchemy import Float, cast, func, literal_column, select, union
+
+from config import settings
+from db.models import BOOK_SORTS, Book
+from db.pagination import keyset_page
+
+
+def _tsquery(text):
+    # каждое слово ищется как префикс: 'мир тум' -> 'мир':* & 'тум':*
+    words = re.findall(r'[^\W_]+', text or '')
+    if not words:
+        return None
+    return func.to_tsquery(literal_column("'russian'"), ' & '.join(f'{word}:*' for word in words))
+
+
+def _exact_titles(text):
+    # название целиком, как введено и с заглавной буквы ('война и мир' -> 'Война и мир')
+    title = ' '.join(text.split())
+    return {title, title[:1].upper() + title[1:]}
+
+
+def search_books(session, text, page_size, cursor=None):
+    """Полнотекстовый поиск по названию и автору, самые релевантные книги первыми.
+
+    Ранжируются не все совпадения: для частых слов («мир», «книга») их сотни тысяч, и ts_rank по всем
+    занимал бы сотни миллисекунд. Кандидаты - SEARCH_CANDIDATES самых популярных совпадений (по индексу
+    сортировки 'popular') и книги, название которых совпадает с запросом целиком. Менее популярная книга
+    с частым словом в названии в выдачу не попадет - ее найдет запрос точнее.
+    Возвращает (rows, next_cursor, prev_cursor) как keyset_page.
+    """
+    tsquery = _tsquery(text)
+    if tsquery is None:
+        return [], None, None
+    popularity, _ = BOOK_SORTS['popular']
+    title, _ = BOOK_SORTS['title']
+    # порядок кандидатов не зависит от расположения строк в таблице, поэтому набор меняется
+    # только с продажами, а не от обновлений книг между запросами страниц
+    popular = (select(Book.id)
+               .where(Book.search_vector.op('@@')(tsquery))
+               .order_by(popularity.desc(), Book.id.desc())
+               .limit(settings.SEARCH_CANDIDATES))
+    exact = select(Book.id).where(title.in_(_exact_titles(text)), Book.search_vector.op('@@')(tsquery))
+    candidates = union(popular, exact).subquery()
+    # ts_rank возвращает real, а значение из курсора приходит как double precision: без приведения
+    # книги с одинаковым рангом не проходят сравнение (rank, id) < (...) и следующая страница пуста
+    rank = cast(func.ts_rank(Book.search_vector, tsquery), Float)
+    keys = [rank.label('sort_key'), Book.id.label('book_id')]
+    query = (session.query(Book.id, Book.title, Book.author, Book.year, Book.cover, Book.cover_thumb, *keys)
+             .join(candidates, candidates.c.id == Book.id))
+    return keyset_page(query, keys, True, page_size, cursor=cursor, scope=f'search:{text}')
@@ -0,0 +1,100 @@
+import hashlib
+import math
+import threading
+
+from sqlalchemy import event, or_, select
+
+from config import settings
+from db.models import User
+
+UNIQUE_FIELDS = ('username', 'email', 'phone_number')
+
+
+class BloomFilter:
+    """Множество строк с ложноположительными ответами, но без ложноотрицательных."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class UserFilter:
+    """Bloom-фильтр занятых логинов, адресов и телефонов: для новых значений проверка не обращается к БД.
+
+    Фильтр свой в каждом процессе и не знает о пользователях, зарегистрированных в других процессах
+    после его построения, поэтому окончательную проверку делает уникальный индекс (см. register).
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = None
+        self._lock = threading.Lock()
+
+    def _build(self, session):
+        bloom = BloomFilter(max(self.capacity, 2 * session.query(User).count()), self.error_rate)
+        rows = session.execute(select(*(getattr(User, field) for field in UNIQUE_FIELDS))
+                               .execution_options(yield_per=10000))
+        for row in rows:
+            for field, value in zip(UNIQUE_FIELDS, row):
+                if value is not None:
+                    bloom.add(f'{field}:{value}')
+        return bloom
+
+    def rebuild(self, session):
+        # фильтр строится под блокировкой: add из других потоков ждет и попадает уже в новый фильтр
+        with self._lock:
+            self._filter = self._build(session)
+
+    def ensure_built(self, session):
+        """Строит фильтр, если его еще нет. Одновременные первые вызовы строят его один раз."""
+        if self._filter is None:
+            with self._lock:
+                if self._filter is None:
+                    self._filter = self._build(session)
+
+    def add(self, field, value):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(f'{field}:{value}')
+
+    def might_contain(self, session, field, value):
+        self.ensure_built(session)
+        return f'{field}:{value}' in self._filter
+
+
+user_filter = UserFilter(settings.USER_FILTER_CAPACITY, settings.USER_FILTER_ERROR_RATE)
+
+
+def taken_fields(session, values, use_filter=True):
+    """Какие из значений {поле: значение} уже заняты другими пользователями. Не больше одного запроса."""
+    if use_filter:
+        values = {field: value for field, value in values.items()
+                  if user_filter.might_contain(session, field, value)}
+    if not values:
+        return set()
+    matches = [(getattr(User, field) == value).label(field) for field, value in values.items()]
+    rows = session.query(*matches).filter(or_(*matches)).limit(len(values)).all()
+    return {field for row in rows for field in values if getattr(row, field)}
+
+
+@event.listens_for(User, 'after_insert')
+def _remember_user(mapper, connection, target):
+    # если транзакция откатится, в фильтре останется лишнее значение - это только лишний запрос к БД
+    for field in UNIQUE_FIELDS:
+        value = getattr(target, field)
+        if value is not None:
+            user_filter.add(field, value)
@@ -0,0 +1,58 @@
+import hashlib
+from datetime import date
+from functools import partial, wraps
+
+from flask import make_response, request, session
+from flask_login import current_user
+
+from config import settings
+from db.catalog_version import catalog_version
+
+
+def _cacheable():
+    # страницы для вошедших пользователей, для посетителей с корзиной в сессии и страницы
+    # с флеш-сообщениями отличаются у каждого клиента
+    return (request.method == 'GET' and not current_user.is_authenticated
+            and '_flashes' not in session and 'cart' not in session)
+
+
+def conditional(view=None, *, sales=False):
+    """ETag и Last-Modified по версии каталога для анонимных GET-запросов.
+
+    sales - страница зависит и от продаж (лидеры недели, сортировка по популярности): True или функция,
+    которая решает это по запросу. Такие страницы меняются с каждой продажей и с началом нового дня
+    и проверяются только по ETag, остальные продажи не сбрасывают.
+    Если копия клиента актуальна, отдается 304 без обращения к представлению и к БД.
+    """
+    if view is None:
+        return partial(conditional, sales=sales)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _cacheable():
+            response = make_response(view(*args, **kwargs))
+            response.cache_control.private = True
+            return response
+
+        version, updated_at, sales_version = catalog_version()
+        tag = f'{version}:{updated_at.isoformat()}'
+        by_sales = sales() if callable(sales) else sales
+        if by_sales:
+            tag += f':{sales_version}:{date.today().isoformat()}'
+        etag = hashlib.sha1(f'{tag}:{request.full_path}'.encode()).hexdigest()
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            # у продаж нет времени изменения, поэтому If-Modified-Since для них не проверяется
+            not_modified = (not by_sales and request.if_modified_since is not None
+                            and request.if_modified_since >= updated_at)
+        response = make_response('', 304) if not_modified else make_response(view(*args, **kwargs))
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            if not by_sales:
+                response.last_modified = updated_at
+            response.cache_control.public = True
+            response.cache_control.max_age = settings.HTTP_CACHE_MAX_AGE
+            response.vary.add('Cookie')
+        return response
+    return wrapper
@@ -0,0 +1,180 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from config import settings
+from db.database import pool_status
+from db.user_cache import user_cache
+from passwords import password_hasher
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.requests = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.over_budget = 0
+
+
+class Metrics:
+    """Метрики процесса: задержка по маршрутам и число/время SQL-запросов на маршрут."""
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, sql_statements, sql_seconds, over_budget=False):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.sql_statements += sql_statements
+            stats.sql_seconds += sql_seconds
+            stats.over_budget += over_budget
+
+    def render(self):
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = [
+                '# HELP bookshop_request_duration_seconds Request latency by endpoint.',
+                '# TYPE bookshop_request_duration_seconds histogram',
+            ]
+            for endpoint, stats in endpoints:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'bookshop_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'bookshop_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats.requests}')
+                lines.append(f'bookshop_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats.seconds}')
+                lines.append(f'bookshop_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats.requests}')
+            lines += [
+                '# HELP bookshop_sql_statements_total SQL statements executed while handling requests.',
+                '# TYPE bookshop_sql_statements_total counter',
+            ]
+            lines += [f'bookshop_sql_statements_total{{endpoint="{endpoint}"}} {stats.sql_statements}'
+                      for endpoint, stats in endpoints]
+            lines += [
+                '# HELP bookshop_sql_seconds_total Time spent in SQL statements while handling requests.',
+                '# TYPE bookshop_sql_seconds_total counter',
+            ]
+            lines += [f'bookshop_sql_seconds_total{{endpoint="{endpoint}"}} {stats.sql_seconds}'
+                      for endpoint, stats in endpoints]
+            lines += [
+                '# HELP bookshop_sql_budget_exceeded_total Requests that ran more SQL statements than the endpoint budget.',
+                '# TYPE bookshop_sql_budget_exceeded_total counter',
+            ]
+            lines += [f'bookshop_sql_budget_exceeded_total{{endpoint="{endpoint}"}} {stats.over_budget}'
+                      for endpoint, stats in endpoints]
+
+        pool = pool_status()
+        lines += [
+            '# HELP bookshop_db_pool_connections Database pool connections by state.',
+            '# TYPE bookshop_db_pool_connections gauge',
+            f'bookshop_db_pool_connections{{state="checked_out"}} {pool["checked_out"]}',
+            f'bookshop_db_pool_connections{{state="checked_in"}} {pool["checked_in"]}',
+            f'bookshop_db_pool_connections{{state="overflow"}} {pool["overflow"]}',
+            '# HELP bookshop_db_pool_wait_seconds_total Time spent waiting for a pooled connection.',
+            '# TYPE bookshop_db_pool_wait_seconds_total counter',
+            f'bookshop_db_pool_wait_seconds_total {pool["wait_seconds_total"]}',
+            '# HELP bookshop_db_pool_waits_total Connection checkouts from the pool.',
+            '# TYPE bookshop_db_pool_waits_total counter',
+            f'bookshop_db_pool_waits_total {pool["waits"]}',
+        ]
+        cache = user_cache.stats()
+        lines += [
+            '# HELP bookshop_user_cache_requests_total load_user cache lookups by result.',
+            '# TYPE bookshop_user_cache_requests_total counter',
+            f'bookshop_user_cache_requests_total{{result="hit"}} {cache["hits"]}',
+            f'bookshop_user_cache_requests_total{{result="miss"}} {cache["misses"]}',
+        ]
+        hasher = password_hasher.stats()
+        lines += [
+            '# HELP bookshop_password_hash_pending Password hashes queued or running in the hashing pool.',
+            '# TYPE bookshop_password_hash_pending gauge',
+            f'bookshop_password_hash_pending {hasher["pending"]}',
+            '# HELP bookshop_password_hash_rejected_total Logins/registrations rejected because the hashing queue was full.',
+            '# TYPE bookshop_password_hash_rejected_total counter',
+            f'bookshop_password_hash_rejected_total {hasher["rejected"]}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(statements, *, version_read=False):
+    """Наибольшее число SQL-запросов на один запрос к маршруту (ставится сразу под @route).
+
+    Превышение пишется в лог и в метрики, а при SQL_BUDGET_STRICT=true запрос завершается ошибкой.
+    Бюджет не должен зависеть от объема данных: рост числа запросов вместе с корзиной, заказом или
+    количеством отзывов - это N+1.
+    version_read - маршрут под @conditional: к statements добавляется один запрос версии каталога для
+    ETag, который выполняется только при промахе ее кэша (раз в CATALOG_VERSION_TTL секунд).
+    """
+    def decorator(view):
+        view.query_budget = statements + int(version_read)
+        return view
+    return decorator
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_started' in g:
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + time.perf_counter() - g.pop('sql_started')
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+
+
+def _check_query_budget(response):
+    budget = getattr(current_app.view_functions.get(request.endpoint), 'query_budget', None)
+    statements = g.get('sql_statements', 0)
+    if budget is not None and statements > budget:
+        g.over_budget = True
+        message = f'{request.endpoint}: {statements} SQL-запросов при бюджете {budget}'
+        if settings.SQL_BUDGET_STRICT:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+def _finish_request(exception=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    endpoint = request.url_rule.endpoint if request.url_rule else 'not_found'
+    metrics.record(endpoint, time.perf_counter() - started, g.get('sql_statements', 0), g.get('sql_seconds', 0.0),
+                   g.get('over_budget', False))
+
+
+def metrics_view():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app, engine):
+    app.before_request(_start_request)
+    app.after_request(_check_query_budget)
+    app.teardown_request(_finish_request)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config import settings
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+@cache
+def _method_prefix(method):
+    # werkzeug дополняет метод параметрами по умолчанию ('scrypt' -> 'scrypt:32768:8:1'), поэтому
+    # префикс, с которым сравниваются сохраненные хеши, берется из настоящего хеша
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def _verify(password_hash, password, method):
+    """Выполняется в процессе пула: (пароль верный, новый хеш, если параметры хеширования поменялись)."""
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if password_hash.split('$', 1)[0] != _method_prefix(method):
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+class PasswordHasher:
+    """Хеширование паролей в отдельных процессах, чтобы вход и регистрация не занимали веб-воркеры.
+
+    Одновременно в работе не больше max_pending паролей, лишние запросы сразу получают PasswordHasherBusy.
+    При workers=0 хеши считаются в текущем процессе (с тем же ограничением очереди).
+    """
+
+    def __init__(self, method, workers, max_pending):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _run(self, function, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+            if self._executor is None and self.workers:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+        try:
+            if executor is None:
+                return function(*args)
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            # процесс пула упал (например, убит по памяти): сломанный пул больше не принимает задачи,
+            # поэтому следующий вызов создаст новый
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Возвращает (пароль верный, новый хеш или None). Новый хеш нужно сохранить у пользователя."""
+        return self._run(_verify, password_hash, password, self.method)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self.pending, 'rejected': self.rejected, 'max_pending': self.max_pending}
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_METHOD, settings.PASSWORD_HASH_WORKERS,
+                                 settings.PASSWORD_HASH_QUEUE)
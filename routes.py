@@ -1,17 +1,62 @@
-from flask import Blueprint, flash, redirect, url_for, render_template, request
+from flask import Blueprint, flash, redirect, url_for, render_template, request, abort
 from flask_wtf import FlaskForm
 from flask_login import login_user, logout_user, current_user, login_required
 from wtforms import StringField, PasswordField, RadioField
 from wtforms.validators import InputRequired, Length, Email, EqualTo, ValidationError
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import Integer, Numeric, cast, column, delete, exists, false, func, insert, literal, select, true, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 
 from db.database import session_scope
-from db.models import User, Book, CartItem, OrderItem, Order, Review
+from db.catalog_import import import_books
+from config import settings
+from db.models import User, Book, CartItem, OrderItem, Order, OrderLine, Review, BOOK_SORTS
+from db.pagination import keyset_page
+from db.search import search_books
+from db.leaderboard import get_top_books, update_leaderboard
+from db.ratings import RATINGS, update_book_rating
+from db.sales import SOLD_STATUSES, record_sales, weekly_top
+from db.catalog_version import bump_catalog_version, bump_sales_version, catalog_version
+from http_cache import conditional
+from db.user_uniqueness import UNIQUE_FIELDS, taken_fields, user_filter
+from passwords import PasswordHasherBusy, password_hasher
+from metrics import query_budget
+import session_cart
 from static.books_data import books_data
 
 
 main_blueprint = Blueprint(name='main', import_name='__name__')
 
+# @query_budget(n): сколько SQL-запросов может выполнить маршрут (проверка - benchmarks/query_budgets.py).
+# В бюджет входит загрузка пользователя при промахе кэша, а чтение версии каталога для ETag
+# у маршрутов под @conditional указывается отдельно: version_read=True.
+
+CATALOG_SECTIONS = {
+    'Художественная литература': ['Детектив', 'Приключения', 'Роман', 'Фантастика', 'Фэнтези'],
+    'Нехудожественная литература': ['Научная литература', 'Саморазвитие'],
+    'Детская литература': ['Детская литература'],
+    'Бизнес литература': ['Бизнес'],
+    'Учебная литература': ['История'],
+    'Книги на иностранном языке': [],
+    'Комиксы, манга, артбуки': []
+}
+ALL_GENRES = [genre for genres in CATALOG_SECTIONS.values() for genre in genres]
+
+SORT_LABELS = {
+    'popular': 'По популярности',
+    'price': 'Сначала дешевле',
+    'rating': 'По рейтингу',
+    'year': 'Сначала новые',
+    'title': 'По названию',
+}
+TAKEN_MESSAGES = {
+    'username': 'Логин занят другим пользователем!',
+    'email': 'Адрес эл.почты используется другим пользователем!',
+    'phone_number': 'Номер телефона используется другим пользователем!',
+}
+PASSWORD_HASHER_BUSY_MESSAGE = 'Сервис перегружен, попробуйте еще раз через несколько секунд.'
+CART_FULL_MESSAGE = f'В корзине может быть не больше {settings.SESSION_CART_MAX_BOOKS} разных книг.'
+
 class RegistrationForm(FlaskForm):
     username = StringField(label='Логин', validators=[InputRequired(), Length(max=50, min=3)])
     email = StringField(label='Электронная почта', validators=[InputRequired(), Email()])
@@ -22,16 +67,19 @@ class RegistrationForm(FlaskForm):
     def validate_phone_number(self, phone_number):
         if not phone_number.data.isdigit():
             raise ValidationError('Некорректный номер телефона!')
-        with session_scope() as session:
-            user = session.query(User).filter_by(phone_number=phone_number.data).first()
-        if user is not None:
-            raise ValidationError('Номер телефона используется другим пользователем!')
 
-    def validate_email(self, email):
+    def validate(self, extra_validators=None):
+        valid = super().validate(extra_validators)
+        # занятость логина, почты и телефона проверяется одним запросом (или без запроса, если значения новые)
+        values = {field: getattr(self, field).data for field in UNIQUE_FIELDS if not getattr(self, field).errors}
         with session_scope() as session:
-            user = session.query(User).filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError('Адрес эл.почты используется другим пользователем!')
+            taken = taken_fields(session, values)
+        return self.mark_taken(taken) and valid
+
+    def mark_taken(self, taken):
+        for field in taken:
+            getattr(self, field).errors.append(TAKEN_MESSAGES[field])
+        return not taken
 
 
 class LoginForm(FlaskForm):
@@ -58,41 +106,54 @@ class ConfirmOrderForm(FlaskForm):
 
 @main_blueprint.route('/valera')    # путь 'разработчика' для заполнения каталога книг.
 def valera():
-    for book in books_data:
-        new_book = Book(
-            title=book['title'],
-            author=book['author'],
-            price=book['price'],
-            genre=book['genre'],
-            cover=book['cover'],
-            description=book['description'],
-            rating=book['rating'],
-            year=book['year'],
-            orders_count=0
-        )
-        with session_scope() as session:
-            session.add(new_book)
+    import_books(books_data)
     return redirect(url_for('main.home'))
 
 @main_blueprint.route('/')
 @main_blueprint.route('/home')
+@query_budget(3, version_read=True)
+@conditional(sales=True)
 def home():
     with session_scope() as session:
-        top_books = session.query(Book).order_by(Book.orders_count.desc()).limit(3)
+        # лидеры недели считаются по продажам по дням только после новой продажи или с началом дня;
+        # пока продаж за неделю нет - лидеры за все время
+        _, _, sales_version = catalog_version()
+        top_books = weekly_top(session, sales_version) or get_top_books(session)
     return render_template('home.html', top_books=top_books)
 
 @main_blueprint.route('/register', methods=['GET', 'POST'])
+@query_budget(3)
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
+        try:
+            password_hash = password_hasher.hash(form.password.data)
+        except PasswordHasherBusy:
+            flash(PASSWORD_HASHER_BUSY_MESSAGE, category='danger')
+            return render_template('register.html', form=form), 503
         new_user = User(username=form.username.data,
                         email=form.email.data,
                         phone_number=form.phone_number.data,
-                        password_hash=generate_password_hash(form.password.data))
-        with session_scope() as session:
-            session.add(new_user)
+                        password_hash=password_hash)
+        try:
+            with session_scope() as session:
+                session.add(new_user)
+                # корзина, собранная до регистрации, сохраняется за новым пользователем
+                if session_cart.cart_counts():
+                    session.flush()
+                    session_cart.merge_session_cart(session, new_user.id)
+        except IntegrityError:
+            # те же данные только что зарегистрировал другой запрос: находим занятые поля уже без фильтра
+            with session_scope() as session:
+                taken = taken_fields(session, {field: getattr(form, field).data for field in UNIQUE_FIELDS},
+                                     use_filter=False)
+            for field in taken:
+                user_filter.add(field, getattr(form, field).data)
+            form.mark_taken(taken)
+            flash(form.errors or 'Ошибка регистрации, попробуйте еще раз.', category='danger')
+            return render_template('register.html', form=form)
         flash('Регистрация прошла успешно.', category='success')
         return redirect(url_for('main.login'))
     elif form.errors:
@@ -100,6 +161,7 @@ def register():
     return render_template('register.html', form=form)
 
 @main_blueprint.route('/login', methods=['GET', 'POST'])
+@query_budget(3)
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.home'))
@@ -107,166 +169,211 @@ def login():
     if form.validate_on_submit():
         with session_scope() as session:
             user = session.query(User).filter_by(email=form.email.data).first()
-            if user and check_password_hash(user.password_hash, form.password.data):
-                login_user(user)
-                flash(f'Добро пожаловать, {user.username}', category='success')
-                return redirect(url_for('main.home'))
+            if user:
+                session.expunge(user)
+        # пароль проверяется без открытой транзакции: хеширование занимает десятки миллисекунд
+        try:
+            verified, new_password_hash = password_hasher.verify(user.password_hash, form.password.data) if user else (False, None)
+        except PasswordHasherBusy:
+            flash(PASSWORD_HASHER_BUSY_MESSAGE, category='danger')
+            return render_template('login.html', form=form), 503
+        if verified:
+            login_user(user)
+            flash(f'Добро пожаловать, {user.username}', category='success')
+            merged = 0
+            if new_password_hash or session_cart.cart_counts():
+                with session_scope() as session:
+                    if new_password_hash:
+                        # параметры хеширования поменялись: пароль перехеширован с новыми
+                        session.add(user)
+                        user.password_hash = new_password_hash
+                    # книги, добавленные в корзину до входа, переносятся в корзину пользователя
+                    merged = session_cart.merge_session_cart(session, user.id)
+            return redirect(url_for('main.get_cart') if merged else url_for('main.home'))
         flash('Ошибка авторизации.', category='danger')
     return render_template('login.html', form=form)
 
 @main_blueprint.route('/logout')
+@query_budget(1)
 @login_required
 def logout():
     logout_user()
     flash('Вы вышли из системы', category='primary')
     return redirect(url_for('main.home'))
 
+def _catalog_sort():
+    sort = request.args.get('sort', 'popular')
+    return sort if sort in BOOK_SORTS else 'popular'
+
 @main_blueprint.route('/catalog/<section>')
+@query_budget(1, version_read=True)
+@conditional(sales=lambda: _catalog_sort() == 'popular')
 def get_catalog_section(section):
-    catalog = {
-        'Художественная литература': ['Детектив', 'Приключения', 'Роман', 'Фантастика', 'Фэнтези'],
-        'Нехудожественная литература': ['Научная литература', 'Саморазвитие'],
-        'Детская литература': ['Детская литература'],
-        'Бизнес литература': ['Бизнес'],
-        'Учебная литература': ['История'],
-        'Книги на иностранном языке': [],
-        'Комиксы, манга, артбуки': []
-    }
     if section == 'Весь ассортимент':
-        genres = ['Детектив', 'Приключения', 'Роман', 'Фантастика', 'Фэнтези', 'Научная литература',
-                  'Саморазвитие','Детская литература', 'Бизнес', 'История']
-        with session_scope() as session:
-            books = session.query(Book).all()
-            for book in books:
-                session.expunge(book)
+        genres = ALL_GENRES
+    elif section in CATALOG_SECTIONS:
+        genres = CATALOG_SECTIONS[section]
     else:
-        genres = catalog[section]
-        with session_scope() as session:
-            books = []
-            for genre in genres:
-                books_in_genre = session.query(Book).filter_by(genre=genre).all()
-                for book in books_in_genre:
-                    session.expunge(book)
-                books.extend(books_in_genre)
-    return render_template('catalog_page.html', section=section, genres=genres, books=books)
-
-@main_blueprint.route('/find_book', methods=['POST'])
+        abort(404)
+    sort = _catalog_sort()
+    sort_expression, descending = BOOK_SORTS[sort]
+    keys = [sort_expression.label('sort_key'), Book.id.label('book_id')]
+    with session_scope() as session:
+        # для карточек каталога нужны только эти поля, объекты Book не создаются
+        query = session.query(Book.id, Book.title, Book.author, Book.year, Book.cover, Book.cover_thumb, *keys)
+        if genres is not ALL_GENRES:
+            query = query.filter(Book.genre.in_(genres))
+        books, next_cursor, prev_cursor = keyset_page(query, keys, descending, settings.CATALOG_PAGE_SIZE,
+                                                      cursor=request.args.get('cursor'), scope=sort)
+    return render_template('catalog_page.html', section=section, genres=genres, books=books,
+                           sorts=SORT_LABELS, sort=sort,
+                           prev_url=prev_cursor and url_for('main.get_catalog_section', section=section, sort=sort, cursor=prev_cursor),
+                           next_url=next_cursor and url_for('main.get_catalog_section', section=section, sort=sort, cursor=next_cursor))
+
+@main_blueprint.route('/find_book', methods=['GET', 'POST'])
+@query_budget(2)
 def find_book():
-    key_word = request.form.get('text')
+    key_word = request.values.get('text', '')
+    cursor = request.args.get('cursor')
     with session_scope() as session:
-        books = session.query(Book).filter((Book.title.ilike(f'%{key_word}%')) | (Book.author.ilike(f'%{key_word}%'))).all()
-        if not books:
-            flash('По Вашему запросу ничего не найдено', category='primary')
-            return redirect(url_for('main.home'))
-        return render_template('catalog_page.html', section='Результаты поиска', genres=[], books=books)
+        books, next_cursor, prev_cursor = search_books(session, key_word, settings.CATALOG_PAGE_SIZE, cursor=cursor)
+    if not books and not cursor:
+        flash('По Вашему запросу ничего не найдено', category='primary')
+        return redirect(url_for('main.home'))
+    return render_template('catalog_page.html', section='Результаты поиска', genres=[], books=books,
+                           prev_url=prev_cursor and url_for('main.find_book', text=key_word, cursor=prev_cursor),
+                           next_url=next_cursor and url_for('main.find_book', text=key_word, cursor=next_cursor))
 
 @main_blueprint.route('/book/<int:id>', methods=['GET', 'POST'])
+@query_budget(4, version_read=True)
+@conditional
 def get_book(id):
     if request.method == 'POST':
         form = request.form
+        rating = form.get('rating', type=int)
+        if rating not in RATINGS:
+            flash('Оценка должна быть от 1 до 5', category='danger')
+            return redirect(url_for('main.get_book', id=id))
         with session_scope() as session:
-            old_review = session.query(Review).filter_by(user_id=current_user.id, book_id=id).first()
-            book = session.query(Book).filter_by(id=id).first()
+            old_review = (session.query(Review).filter_by(user_id=current_user.id, book_id=id)
+                          .with_for_update().first())
             if old_review:
-                book.rating = round((book.rating * book.review_count - old_review.rating + int(form['rating'])) / book.review_count, 1)
-                old_review.rating = form['rating']
+                update_book_rating(session, id, rating, old_rating=old_review.rating)
+                old_review.rating = rating
                 old_review.review = form['text']
-                session.add(old_review)
                 flash('Отзыв обновлен', category='success')
 
             else:
-                book.review_count += 1
-                book.rating = round((book.rating * book.review_count + int(form['rating'])) / (book.review_count + 1), 1)
-                new_review = Review(user_id=current_user.id, book_id=id, review=form['text'], rating=form['rating'])
+                new_review = Review(user_id=current_user.id, book_id=id, review=form['text'], rating=rating)
                 session.add(new_review)
+                update_book_rating(session, id, rating)
                 flash('Отзыв опубликован', category='success')
+            bump_catalog_version(session)
         return redirect(url_for('main.get_book', id=id))
 
-    book_in_cart = None
-    user_left_a_review = None
+    if current_user.is_authenticated:
+        book_in_cart = exists().where(CartItem.user_id == current_user.id, CartItem.book_id == Book.id)
+        user_left_a_review = exists().where(Review.user_id == current_user.id, Review.book_id == Book.id)
+    else:
+        book_in_cart = true() if id in session_cart.cart_counts() else false()
+        user_left_a_review = false()
+    review_keys = [Review.id.label('review_id')]
     with session_scope() as session:
-        book = session.query(Book).filter_by(id=id).first()
-        session.expunge(book)
-        reviews = session.query(Review).filter_by(book_id=id).all()
-        for review in reviews:
-            username = review.user.username
-            session.expunge(review)
-            review.username = username
-        if current_user.is_authenticated:
-            book_in_cart = session.query(CartItem).filter_by(user_id=current_user.id, book_id=id).first()
-            user_left_a_review = session.query(Review).filter_by(user_id=current_user.id, book_id=id).first()
-        return render_template('book_page.html', book=book, reviews=reviews,
-                               book_in_cart=book_in_cart, user_left_a_review=user_left_a_review)
+        # книга и отметки «в корзине» / «отзыв оставлен» одним запросом
+        row = (session.query(Book, book_in_cart.label('book_in_cart'), user_left_a_review.label('user_left_a_review'))
+               .filter(Book.id == id).first())
+        if row is None:
+            abort(404)
+        session.expunge(row.Book)
+        # отзывы вместе с именами авторов, постранично от новых к старым
+        reviews_query = (session.query(Review.rating, Review.review, User.username, *review_keys)
+                         .join(User, User.id == Review.user_id)
+                         .filter(Review.book_id == id))
+        reviews, next_cursor, prev_cursor = keyset_page(reviews_query, review_keys, True, settings.REVIEWS_PAGE_SIZE,
+                                                        cursor=request.args.get('cursor'), scope='reviews')
+    return render_template('book_page.html', book=row.Book, reviews=reviews,
+                           book_in_cart=row.book_in_cart, user_left_a_review=row.user_left_a_review,
+                           prev_url=prev_cursor and url_for('main.get_book', id=id, cursor=prev_cursor),
+                           next_url=next_cursor and url_for('main.get_book', id=id, cursor=next_cursor))
 
 @main_blueprint.route('/add_to_cart/<int:id>')
-@login_required
+@query_budget(2)
 def add_to_cart(id):
+    if current_user.is_anonymous:
+        # корзина анонимного посетителя хранится в cookie сессии, без записи в БД
+        if not session_cart.add_book(id):
+            flash(CART_FULL_MESSAGE, category='danger')
+        return redirect(url_for('main.get_book', id=id))
     with session_scope() as session:
-        book = session.query(Book).filter_by(id=id).first()
-        session.expunge(book)
-        new_cart_item = CartItem(user_id=current_user.id, book_id=id)
-        session.add(new_cart_item)
+        # повторное добавление той же книги ничего не меняет
+        session.execute(pg_insert(CartItem).values(user_id=current_user.id, book_id=id)
+                        .on_conflict_do_nothing(index_elements=[CartItem.user_id, CartItem.book_id]))
     return redirect(url_for('main.get_book', id=id))
 
 @main_blueprint.route('/cart', methods=['GET', 'POST'])
-@login_required
+@query_budget(3)
 def get_cart():
+    if current_user.is_anonymous:
+        if request.method == 'POST':
+            # оформление заказа требует входа, корзина из сессии перенесется в БД при входе
+            flash('Войдите или зарегистрируйтесь, чтобы оформить заказ', category='primary')
+            return redirect(url_for('main.login'))
+        with session_scope() as session:
+            cart_items = session_cart.cart_items(session)
+        return render_template('cart.html', cart_items=cart_items)
+
     if request.method == 'POST':
+        new_order_items_id = request.form.getlist('for_order', type=int)
         with session_scope() as session:
-            old_order_items = session.query(OrderItem).filter_by(user_id=current_user.id).all()
-            for item in old_order_items:
-                session.delete(item)
+            session.execute(delete(OrderItem).where(OrderItem.user_id == current_user.id),
+                            execution_options={'synchronize_session': False})
+            if new_order_items_id:
+                # позиции заказа копируются из корзины пользователя одним INSERT ... SELECT
+                snapshot = (select(literal(current_user.id), CartItem.book_id, Book.title, CartItem.count, Book.price,
+                                   func.round(cast(CartItem.count * Book.price, Numeric), 2))
+                            .join(Book, Book.id == CartItem.book_id)
+                            .where(CartItem.user_id == current_user.id, CartItem.id.in_(new_order_items_id)))
+                session.execute(insert(OrderItem).from_select(
+                    ['user_id', 'book_id', 'title', 'count', 'price', 'total_price'], snapshot))
 
-        new_order_items_id = request.form.getlist('for_order')
         if not new_order_items_id:
             flash('Выберите хотя бы один товар', category='danger')
             return redirect(url_for('main.get_cart'))
-
-        for item_id in new_order_items_id:
-            with session_scope() as session:
-                cart_item = session.query(CartItem).filter_by(id=item_id).first()
-                new_order_item = OrderItem(
-                    user_id=current_user.id,
-                    book_id=cart_item.book_id,
-                    title=cart_item.book.title,
-                    count=cart_item.count,
-                    price=cart_item.book.price,
-                    total_price=round(cart_item.count * cart_item.book.price, 2)
-                )
-                session.add(new_order_item)
         return redirect(url_for('main.create_order'))
 
     with session_scope() as session:
-        cart_items = session.query(CartItem).filter_by(user_id=current_user.id).all()
-        for item in cart_items:
-            title = item.book.title
-            author = item.book.author
-            cover = item.book.cover
-            price = item.book.price
-
-            session.expunge(item)
-
-            item.title = title
-            item.author = author
-            item.cover = cover
-            item.price = price
-        return render_template('cart.html', cart_items=cart_items)
+        # позиции корзины вместе с данными книг одним запросом
+        cart_items = (session.query(CartItem.id, CartItem.book_id, CartItem.count, Book.title, Book.author,
+                                    Book.cover, Book.cover_thumb, Book.price)
+                      .join(Book, Book.id == CartItem.book_id)
+                      .filter(CartItem.user_id == current_user.id)
+                      .order_by(CartItem.id)
+                      .all())
+    return render_template('cart.html', cart_items=cart_items)
 
 
 @main_blueprint.route('/update_cart', methods=['POST'])
-@login_required
+@query_budget(3)
 def update_cart():
     if request.method == 'POST':
         item_id = int(request.values.get('item_id'))
         new_count_item = int(request.values.get('new_count_item'))
+        if current_user.is_anonymous:
+            # для корзины в сессии id позиции - это id книги
+            session_cart.set_count(item_id, new_count_item)
+            return redirect(url_for('main.get_cart'))
         with session_scope() as session:
-            item = session.query(CartItem).filter_by(id=item_id).first()
-            item.count = new_count_item
+            item = session.query(CartItem).filter_by(id=item_id, user_id=current_user.id).first()
+            if item:
+                item.count = new_count_item
         return redirect(url_for('main.get_cart'))
 
 @main_blueprint.route('/delete_item/<int:id>')
-@login_required
+@query_budget(3)
 def delete_item(id):
+    if current_user.is_anonymous:
+        session_cart.remove_book(id)
+        return redirect(url_for('main.get_cart'))
     with session_scope() as session:
         item = session.query(CartItem).filter_by(id=id, user_id=current_user.id).first()
         if item:
@@ -275,6 +382,7 @@ def delete_item(id):
 
 
 @main_blueprint.route('/create_order', methods=['GET', 'POST'])
+@query_budget(6)
 @login_required
 def create_order():
     form = OrderForm()
@@ -287,16 +395,23 @@ def create_order():
             new_order = Order(
                 user_id=current_user.id,
                 address=form.address.data,
-                books={item.book_id: item.count for item in order_items},
                 details={
                     'recipient': form.recipient.data,
                     'phone_number': form.phone_number.data,
                     'delivery': form.delivery.data,
                     'payment': form.payment.data,
-                    'total': round(sum([item.total_price for item in order_items]),2)
+                    'total': round(sum([item.total_price for item in order_items]),2),
                 }
             )
             session.add(new_order)
+            session.flush()
+            # состав заказа с ценами на момент покупки - одним запросом
+            if order_items:
+                session.execute(insert(OrderLine), [
+                    {'order_id': new_order.id, 'user_id': item.user_id, 'book_id': item.book_id, 'title': item.title,
+                     'count': item.count, 'price': item.price, 'total_price': item.total_price}
+                    for item in order_items
+                ])
         return redirect(url_for('main.confirm_order'))
 
     elif form.errors:
@@ -312,29 +427,38 @@ def create_order():
 
 
 @main_blueprint.route('/confirm_order', methods=['GET', 'POST'])
+@query_budget(11)
 @login_required
 def confirm_order():
     form = ConfirmOrderForm()
     if form.validate_on_submit():
         with session_scope() as session:
-            order_items_for_delete = session.query(OrderItem).filter_by(user_id=current_user.id).all()
-            books_id = [item.book_id for item in order_items_for_delete]
-            for item in order_items_for_delete:
-                session.delete(item)
-            for book_id in books_id:
-                cart_item_for_delete = session.query(CartItem).filter_by(user_id=current_user.id, book_id=book_id).first()
-                session.delete(cart_item_for_delete)
-
-            unconfirmed_order = session.query(Order).filter_by(user_id=current_user.id, status='Не подтвержден').first()
+            unconfirmed_order = (session.query(Order).filter_by(user_id=current_user.id, status='Не подтвержден')
+                                 .with_for_update().first())
+            if unconfirmed_order is None:
+                return redirect(url_for('main.get_orders'))
             unconfirmed_order.status = form.confirm.data
-
-            books_sold = unconfirmed_order.books
-            print(books_sold)
-            print(type(books_sold))
-            for book_id, count_sold in books_sold.items():
-                book = session.query(Book).filter_by(id=book_id).first()
-                book.orders_count += count_sold
+            record_sales(session, unconfirmed_order)
+            books_sold = dict(session.execute(
+                select(OrderLine.book_id, func.sum(OrderLine.count))
+                .where(OrderLine.order_id == unconfirmed_order.id).group_by(OrderLine.book_id)).all())
+
+            # фиксированное число запросов при любом размере корзины
+            session.execute(delete(OrderItem).where(OrderItem.user_id == current_user.id),
+                            execution_options={'synchronize_session': False})
+            # заказ без позиций (например, оформленный повторно из другой вкладки) книг не продает,
+            # а VALUES без строк - синтаксическая ошибка
+            if books_sold:
+                session.execute(delete(CartItem).where(CartItem.user_id == current_user.id, CartItem.book_id.in_(books_sold)),
+                                execution_options={'synchronize_session': False})
+                sold = values(column('book_id', Integer), column('count_sold', Integer), name='sold').data(list(books_sold.items()))
+                session.execute(update(Book).where(Book.id == sold.c.book_id)
+                                .values(orders_count=Book.orders_count + sold.c.count_sold),
+                                execution_options={'synchronize_session': False})
+                update_leaderboard(session, list(books_sold))
             flash('Заказ оформлен!', category='success')
+        if books_sold:
+            bump_sales_version()
         return redirect(url_for('main.home'))
 
     elif form.errors:
@@ -346,6 +470,7 @@ def confirm_order():
     return render_template('confirm_order.html', order=unconfirmed_order, form=form)
 
 @main_blueprint.route('/user_orders')
+@query_budget(2)
 @login_required
 def get_orders():
     with session_scope() as session:
@@ -353,26 +478,42 @@ def get_orders():
         return render_template('user_orders.html', orders=orders)
 
 @main_blueprint.route('/get_order/<int:id>')
+@query_budget(4)
 @login_required
 def get_order(id):
     with session_scope() as session:
         order = session.query(Order).filter_by(id=id, user_id=current_user.id).first()
         if order:
-            order_books = []
-            books_id_and_count = order.books
-            for book_id, count in books_id_and_count.items():
-                book = session.query(Book).filter_by(id=book_id).first()
-                book_info = {'title': book.title, 'count': count, 'price': book.price, 'total': book.price * count}
-                order_books.append(book_info)
-            return render_template('order_info.html', order=order, books = order_books)
+            order_books = (session.query(OrderLine.title, OrderLine.count, OrderLine.price,
+                                         OrderLine.total_price.label('total'))
+                           .filter_by(order_id=order.id).order_by(OrderLine.id).all())
+            if not order_books and order.books:
+                # заказ еще не перенесен в order_lines (см. flask backfill-order-lines)
+                order_books = order.details.get('items')
+            if order_books is None:
+                # самые старые заказы: цены текущие
+                books = session.query(Book.id, Book.title, Book.price).filter(Book.id.in_([int(book_id) for book_id in order.books])).all()
+                books = {book.id: book for book in books}
+                order_books = []
+                for book_id, count in order.books.items():
+                    book = books[int(book_id)]
+                    order_books.append({'title': book.title, 'count': count, 'price': book.price, 'total': book.price * count})
+            return render_template('order_info.html', order=order, books=order_books)
         return redirect(url_for('main.get_orders'))
 
 @main_blueprint.route('/cancel_order/<int:id>')
+@query_budget(5)
 @login_required
 def cancel_order(id):
     with session_scope() as session:
-        order = session.query(Order).filter_by(id=id, user_id=current_user.id).first()
+        order = session.query(Order).filter_by(id=id, user_id=current_user.id).with_for_update().first()
+        sold = order is not None and order.status in SOLD_STATUSES
         if order:
+            if sold:
+                # в продажах заказ учтен при подтверждении
+                record_sales(session, order, sign=-1)
             order.status = 'Отменён'
             flash('Заказ отменён', category='primary')
-        return redirect(url_for('main.get_orders'))
\ No newline at end of file
+    if sold:
+        bump_sales_version()
+    return redirect(url_for('main.get_orders'))
\ No newline at end of file
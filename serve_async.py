@@ -0,0 +1,49 @@
+"""Асинхронный режим сервера: один процесс держит сотни одновременных запросов.
+
+    python serve_async.py
+    gunicorn -k gevent --worker-connections 500 serve_async:app
+
+Каждый запрос обрабатывается в гринлете gevent. Пока psycopg2 ждет ответа БД, процесс
+переключается на другие запросы, поэтому число запросов в работе не ограничено числом
+потоков или воркеров. Обычный режим (python app.py) не меняется.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import psycopg2
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.socket import wait_read, wait_write
+from psycopg2 import extensions
+
+
+def _gevent_wait_callback(connection, timeout=None):
+    # psycopg2 не знает о gevent: вместо блокировки ждем сокет БД через цикл событий gevent
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+
+extensions.set_wait_callback(_gevent_wait_callback)
+
+from app import app
+from config import settings
+from db.database import init_db, session_scope
+from db.user_uniqueness import user_filter
+
+# gunicorn импортирует этот модуль в каждом воркере и init_db не вызывает: Bloom-фильтр регистрации
+# строится при запуске процесса, а не в первом запросе на регистрацию
+with session_scope() as session:
+    user_filter.ensure_built(session)
+
+if __name__ == '__main__':
+    init_db()
+    WSGIServer(('127.0.0.1', 5000), app, spawn=Pool(settings.ASYNC_MAX_REQUESTS)).serve_forever()
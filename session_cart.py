@@ -0,0 +1,91 @@
+from flask import session
+from sqlalchemy import Integer, column, func, literal, select, values
+from sqlalchemy.dialects.postgresql import insert
+
+from config import settings
+from db.models import Book, CartItem
+
+# корзина анонимного посетителя хранится в подписанной cookie сессии списком пар [book_id, count]
+# и не пишет в БД; при входе или регистрации она переносится в cart_items (merge_session_cart)
+CART_KEY = 'cart'
+MAX_BOOK_COUNT = 10
+
+
+def cart_counts():
+    """{book_id: количество} в порядке добавления."""
+    return {book_id: count for book_id, count in session.get(CART_KEY, [])}
+
+
+def _save(counts):
+    if counts:
+        session[CART_KEY] = [[book_id, count] for book_id, count in counts.items()]
+    else:
+        session.pop(CART_KEY, None)
+
+
+def add_book(book_id):
+    """Добавляет книгу в корзину. False, если в корзине уже SESSION_CART_MAX_BOOKS разных книг."""
+    counts = cart_counts()
+    if book_id in counts:
+        return True
+    if len(counts) >= settings.SESSION_CART_MAX_BOOKS:
+        return False
+    counts[book_id] = 1
+    _save(counts)
+    return True
+
+
+def set_count(book_id, count):
+    counts = cart_counts()
+    if book_id in counts:
+        counts[book_id] = min(max(count, 1), MAX_BOOK_COUNT)
+        _save(counts)
+
+
+def remove_book(book_id):
+    counts = cart_counts()
+    if counts.pop(book_id, None) is not None:
+        _save(counts)
+
+
+def _cart_values(counts):
+    return values(column('book_id', Integer), column('count', Integer), column('position', Integer),
+                  name='session_cart').data([(book_id, count, position)
+                                             for position, (book_id, count) in enumerate(counts.items())])
+
+
+def cart_items(db_session):
+    """Позиции корзины из сессии с данными книг одним запросом, в том же виде, что и корзина из БД.
+
+    id позиции - это id книги: по нему корзина в сессии изменяется и удаляется (update_cart, delete_item).
+    Книги, которых уже нет в каталоге, пропускаются.
+    """
+    counts = cart_counts()
+    if not counts:
+        return []
+    cart = _cart_values(counts)
+    return (db_session.query(Book.id.label('id'), Book.id.label('book_id'), cart.c.count, Book.title, Book.author,
+                             Book.cover, Book.cover_thumb, Book.price)
+            .join(cart, cart.c.book_id == Book.id)
+            .order_by(cart.c.position)
+            .all())
+
+
+def merge_session_cart(db_session, user_id):
+    """Переносит корзину из сессии в корзину пользователя одним INSERT ... ON CONFLICT и очищает ее.
+
+    Количество книги, которая уже лежит в корзине пользователя, складывается (не больше MAX_BOOK_COUNT).
+    Возвращает число перенесенных позиций.
+    """
+    counts = cart_counts()
+    if not counts:
+        return 0
+    cart = _cart_values(counts)
+    rows = select(literal(user_id), Book.id, cart.c.count).join(cart, cart.c.book_id == Book.id)
+    stmt = insert(CartItem).from_select(['user_id', 'book_id', 'count'], rows)
+    merged = db_session.execute(stmt.on_conflict_do_update(
+        index_elements=[CartItem.user_id, CartItem.book_id],
+        set_={'count': func.least(func.coalesce(CartItem.count, 1) + stmt.excluded.count, MAX_BOOK_COUNT)}
+    )).rowcount
+    session.pop(CART_KEY, None)
+    return merged
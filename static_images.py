@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+
+from flask import send_from_directory, url_for
+from markupsafe import Markup, escape
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # без Pillow шаблоны отдают исходные картинки
+    Image = ImageOps = features = None
+
+# картинки разделов каталога показываются в блоке 200x150 (см. .catalog-section img), 400 - для экранов 2x
+IMAGE_WIDTHS = (200, 400)
+IMAGE_ASPECT = (4, 3)
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.jfif', '.png')
+QUALITY = {'avif': 50, 'webp': 80, 'jpeg': 82}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+ASSETS_MAX_AGE = 365 * 24 * 60 * 60
+
+_manifest = {}
+
+
+def _formats():
+    formats = ['avif'] if features.check('avif') else []
+    return formats + ['webp', 'jpeg']
+
+
+def encode_image(image, image_format):
+    buffer = BytesIO()
+    options = {'quality': QUALITY[image_format]}
+    if image_format == 'jpeg':
+        options.update(optimize=True, progressive=True)
+    image.save(buffer, format=image_format.upper(), **options)
+    return buffer.getvalue()
+
+
+def write_file(target, data):
+    # через временный файл с pid в имени: воркеры, которые собирают картинки одновременно, не пишут
+    # в один файл, а читатели не видят недописанный
+    temporary = f'{target}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, target)
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def _is_fresh(manifest, source_dir):
+    sources = {name for name in os.listdir(source_dir) if name.lower().endswith(SOURCE_EXTENSIONS)}
+    if sources != {key.split('/', 1)[1] for key in manifest}:
+        return False
+    return all(entry['source'] == _source_stamp(os.path.join(source_dir, key.split('/', 1)[1]))
+               for key, entry in manifest.items())
+
+
+def build_static_images(static_folder):
+    """Нарезает static/img в WebP/AVIF/JPEG нужных размеров с хешем содержимого в имени файла.
+
+    Результат кладется в static/build, соответствие исходных имен вариантам - в static/build/manifest.json.
+    """
+    source_dir = os.path.join(static_folder, 'img')
+    build_dir = os.path.join(static_folder, 'build')
+    os.makedirs(build_dir, exist_ok=True)
+    manifest = {}
+    for name in sorted(os.listdir(source_dir)):
+        if not name.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        path = os.path.join(source_dir, name)
+        stem = os.path.splitext(name)[0]
+        with Image.open(path) as original:
+            original = ImageOps.exif_transpose(original).convert('RGB')
+            variants = {image_format: [] for image_format in _formats()}
+            for width in IMAGE_WIDTHS:
+                height = width * IMAGE_ASPECT[1] // IMAGE_ASPECT[0]
+                resized = ImageOps.fit(original, (width, height), Image.Resampling.LANCZOS)
+                for image_format in variants:
+                    data = encode_image(resized, image_format)
+                    digest = hashlib.sha256(data).hexdigest()[:12]
+                    extension = 'jpg' if image_format == 'jpeg' else image_format
+                    filename = f'{stem}.{width}w.{digest}.{extension}'
+                    target = os.path.join(build_dir, filename)
+                    if not os.path.exists(target):
+                        write_file(target, data)
+                    variants[image_format].append([filename, width])
+        manifest[f'img/{name}'] = {
+            'source': _source_stamp(path),
+            'width': IMAGE_WIDTHS[0],
+            'height': IMAGE_WIDTHS[0] * IMAGE_ASPECT[1] // IMAGE_ASPECT[0],
+            'variants': variants,
+        }
+
+    write_file(os.path.join(build_dir, 'manifest.json'), json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest
+
+
+def load_static_images(static_folder):
+    """Читает манифест, при необходимости (и если установлен Pillow) пересобирает варианты картинок."""
+    global _manifest
+    manifest_path = os.path.join(static_folder, 'build', 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as file:
+            manifest = json.load(file)
+    if Image is not None and not _is_fresh(manifest, os.path.join(static_folder, 'img')):
+        manifest = build_static_images(static_folder)
+    _manifest = manifest
+    return manifest
+
+
+def image_srcset(filename, image_format='webp'):
+    entry = _manifest.get(filename)
+    if entry is None or image_format not in entry['variants']:
+        return ''
+    return ', '.join(f"{url_for('assets', filename=name)} {width}w" for name, width in entry['variants'][image_format])
+
+
+def picture(filename, alt='', sizes=None):
+    """<picture> с AVIF/WebP и JPEG-запасным вариантом; без собранных вариантов - обычный <img> с оригиналом."""
+    entry = _manifest.get(filename)
+    if entry is None:
+        return Markup(f'<img src="{url_for("static", filename=filename)}" alt="{escape(alt)}">')
+    sizes = sizes or f"{entry['width']}px"
+    sources = ''.join(
+        f'<source type="{MIME_TYPES[image_format]}" srcset="{image_srcset(filename, image_format)}" sizes="{sizes}">'
+        for image_format in entry['variants'] if image_format in MIME_TYPES
+    )
+    fallback = entry['variants']['jpeg'][0][0]
+    return Markup(
+        f'<picture>{sources}<img src="{url_for("assets", filename=fallback)}" '
+        f'srcset="{image_srcset(filename, "jpeg")}" sizes="{sizes}" '
+        f'width="{entry["width"]}" height="{entry["height"]}" loading="lazy" alt="{escape(alt)}"></picture>'
+    )
+
+
+def send_immutable(directory, filename):
+    # в имени файла хеш содержимого: новая версия картинки получает новый адрес, старый кэш можно не проверять
+    response = send_from_directory(directory, filename, max_age=ASSETS_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_static_images(app):
+    build_dir = os.path.join(app.static_folder, 'build')
+    app.add_url_rule('/assets/<path:filename>', 'assets', lambda filename: send_immutable(build_dir, filename))
+    app.jinja_env.globals.update(picture=picture, image_srcset=image_srcset)
+    load_static_images(app.static_folder)